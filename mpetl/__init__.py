@@ -1,7 +1,13 @@
 __author__ = 'Jorge Herskovic <jherskovic@gmail.com>'
 
 from .pipeline import _Pipeline
-from .messaging import MessagingCenter
+from .messaging import MessagingCenter, worker_sender
+from .transport import SharedMemoryQueue, SpillingQueue
+from .chunking import AutoChunk
+from .pool import WorkerPool
+from .cache import CacheSpec
+from .aio import AsyncPipeline
+from .cluster import Coordinator
 from .util import dprint, trap_under_nose
 
 # The following class is the one actually meant for instantiation by clients of this library.
@@ -10,23 +16,35 @@ from .util import dprint, trap_under_nose
 
 class Pipeline(_Pipeline):
     _messaging = None
+    # Keyword arguments for the MessagingCenter, e.g. batch_size and linger. Set them before creating the first named
+    # Pipeline.
+    messaging_options = {}
 
-    def __init__(self, name=None, max_size=-1):
-        super().__init__(max_size)
+    def __init__(self, name=None, max_size=-1, direct_routing=False, **kwargs):
+        super().__init__(max_size, **kwargs)
+        if name and self._keyed:
+            # Messages go straight into the input queue, without the numbers that ordering and checkpoints rely on.
+            raise ValueError("Named pipelines receive messages from other pipelines, so they can't be ordered or "
+                             "checkpointed.")
         self._name = name
+        self._direct_routing = direct_routing
 
         # We only need messaging capabilities if we have named Pipelines; therefore we only check for (and start) the
         # messaging center if the Pipeline's name is set.
         if self._name:
             if Pipeline._messaging is None:
-                Pipeline._messaging = MessagingCenter()
+                Pipeline._messaging = MessagingCenter(**Pipeline.messaging_options)
                 Pipeline._messaging.start()
 
     def start(self):
         super().start()
         # Register this Pipeline with the central MessagingCenter.
         if self._name:
-            Pipeline._messaging.register_pipeline_queue(self._name, self.input_queue)
+            Pipeline._messaging.register_pipeline_queue(self._name, self.input_queue, self._direct_routing)
+
+    def _messaging_sender(self):
+        if Pipeline._messaging is not None:
+            return Pipeline._messaging.sender()
 
     def join(self):
         if self._name is not None:
@@ -43,8 +61,10 @@ class Pipeline(_Pipeline):
     @staticmethod
     def send_multiple(dest, obj_list):
         """Sends a list of picklable objects to another named pipeline."""
-        if Pipeline._messaging:
-            Pipeline._messaging.send_message(dest, obj_list)
+        # Workers started with spawn or forkserver have a fresh copy of this class, and were given a sender instead
+        sender = Pipeline._messaging or worker_sender()
+        if sender:
+            sender.send_message(dest, obj_list)
         else:
             raise ValueError("There are no named pipelines.")
 
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .pipeline import SequenceError
+
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+# Marks the end of the results on their way from the reading thread to the event loop
+_END = object()
+
+
+class AsyncPipeline(object):
+    """Drives a Pipeline from an asyncio event loop without blocking it.
+
+    Feeding blocks whenever the pipeline's first queue is full (or its reorder window is), so feed() and feed_chunk()
+    hand their chunks to a single feeding thread, in the order they were called, and return once the chunk is in the
+    pipeline; the coroutines that called them wait in the meantime, and the loop keeps running. Results are read by a
+    single thread too, which hands them to the loop and stops reading while max_pending of them haven't been taken by
+    results() yet, so a slow consumer holds the pipeline back instead of piling results up in memory.
+
+    Everything else (add_task, start, stats, ...) is passed on to the wrapped pipeline as it is."""
+
+    def __init__(self, pipeline, max_pending=1000):
+        self._pipeline = pipeline
+        self._feeder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mpetl-feed")
+        self._input_closed = False
+        # Results handed to the loop that results() hasn't taken yet
+        self._pending = threading.Semaphore(max_pending)
+        self._reader = None
+        self._failure = None
+        self._abandoned = False
+
+    def __getattr__(self, name):
+        return getattr(self._pipeline, name)
+
+    async def _in_feeder(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._feeder, method, *args)
+
+    async def feed_chunk(self, chunk):
+        """Feeds a chunk of items (i.e. a list of items) to the pipeline, waiting for room in its first queue."""
+        if self._input_closed:
+            raise SequenceError("You are feeding a pipeline whose input was closed.")
+        await self._in_feeder(self._pipeline.feed_chunk, chunk)
+
+    async def feed(self, item):
+        """Feeds a single item to the pipeline."""
+        await self.feed_chunk([item])
+
+    async def close_input(self):
+        """Ends the input once everything fed so far is in the pipeline (see Pipeline.close_input)."""
+        if self._input_closed:
+            return
+        self._input_closed = True
+        await self._in_feeder(self._pipeline.close_input)
+        self._feeder.shutdown(wait=False)
+
+    async def join(self):
+        """Closes the input and waits for the pipeline's workers to finish, for pipelines whose results aren't read."""
+        await self.close_input()
+        await asyncio.get_running_loop().run_in_executor(None, self._pipeline.join)
+
+    async def results(self):
+        """Yields the pipeline's results as they come out, until close_input() was awaited and everything fed before
+        it has gone through. Once they're done, the pipeline is joined. If the iteration stops early, the remaining
+        results are read and thrown away, so that the pipeline can still finish."""
+        if self._reader is not None:
+            raise RuntimeError("The results of an AsyncPipeline can only be read once.")
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Queue()
+        self._reader = threading.Thread(target=self._read, args=(loop, ready), daemon=True)
+        self._reader.start()
+        try:
+            while True:
+                result = await ready.get()
+                if result is _END:
+                    break
+                self._pending.release()
+                yield result
+        finally:
+            self._abandoned = True
+            # Wakes the reader up, in case it's waiting for room
+            self._pending.release()
+        if self._failure is not None:
+            raise self._failure
+
+    def _read(self, loop, ready):
+        """Runs in the reading thread: moves the results from the pipeline to the event loop."""
+        try:
+            for result in self._pipeline.results():
+                if self._abandoned:
+                    continue
+                self._pending.acquire()
+                if self._abandoned:
+                    continue
+                loop.call_soon_threadsafe(ready.put_nowait, result)
+        except BaseException as e:
+            self._failure = e
+        if not self._abandoned and not loop.is_closed():
+            loop.call_soon_threadsafe(ready.put_nowait, _END)
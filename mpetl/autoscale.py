@@ -0,0 +1,94 @@
+import threading
+import time
+from .util import dprint
+
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+
+class Autoscaler(object):
+    """Background controller that adds and retires workers of a pipeline's autoscaling tasks.
+
+    Every interval seconds it looks at each autoscaling task's input backlog (if the queue can tell) and at how much
+    of the last interval its workers spent busy. A task with a backlog, or whose workers were nearly always busy, gets
+    one more worker as long as the pipeline stays within cpu_budget processes; a task whose workers mostly waited for
+    input and that has nothing queued loses one, down to its min_num."""
+
+    def __init__(self, tasks, queues, cpu_budget, interval=0.5, busy_above=0.9, idle_below=0.3):
+        self._tasks = tasks
+        self._queues = queues
+        self._cpu_budget = cpu_budget
+        self._interval = interval
+        self._busy_above = busy_above
+        self._idle_below = idle_below
+        self._last_busy = {}
+        self._frozen = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def join(self, task):
+        """Joins task while it keeps scaling up to work through its remaining input. Once it's done, it's never
+        scaled again."""
+        with self._lock:
+            task.close()
+        task.join()
+        with self._lock:
+            self._frozen.add(task)
+        # In case a worker was added between the end of the first join and the freeze
+        task.join()
+
+    def _backlog(self, queue):
+        try:
+            return queue.qsize()
+        except NotImplementedError:
+            # Mac OS X doesn't implement qsize() on multiprocessing Queues.
+            return None
+
+    def _utilisation(self, task):
+        # Busy time includes the stretch each worker is in the middle of, so that a worker partway through a long
+        # chunk doesn't look idle; intervals are measured rather than assumed, since ticks can run late.
+        now = time.perf_counter()
+        busy = task._stats.snapshot()["totals"]["busy_time"] + task._stats.unpublished_busy_time()
+        previous = self._last_busy.get(task)
+        self._last_busy[task] = (busy, now)
+        if previous is None or now <= previous[1]:
+            return None
+        previous_busy, previous_now = previous
+        elapsed = now - previous_now
+        return (busy - previous_busy) / (elapsed * max(task.live_workers, 1))
+
+    def _total_processes(self):
+        return sum(t.live_processes for t in self._tasks)
+
+    def tick(self):
+        with self._lock:
+            for task, queue in zip(self._tasks, self._queues):
+                if task.autoscaling and task not in self._frozen:
+                    self._scale(task, queue)
+
+    def _scale(self, task, queue):
+        task.reap()
+        backlog = self._backlog(queue)
+        utilisation = self._utilisation(task)
+        # Without a previous sample there's no utilisation yet, and only the backlog counts.
+        starved = (utilisation is not None and utilisation > self._busy_above) or \
+                  (backlog is not None and backlog > task.live_workers)
+        idle = utilisation is not None and utilisation < self._idle_below and not backlog
+
+        if starved and self._total_processes() < self._cpu_budget:
+            if task.add_worker():
+                dprint("Autoscaler added a worker to", task.name, "- now", task.live_workers)
+        elif idle:
+            if task.retire_worker():
+                dprint("Autoscaler retired a worker from", task.name, "- now", task.live_workers)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.tick()
@@ -0,0 +1,195 @@
+"""Measures the overhead of running work through mpetl pipelines, so that releases and machines can be compared.
+
+Run it with `python -m mpetl.bench --help`. Every task in here does (almost) nothing, so the time per item is what
+the pipeline itself costs: pickling, queues, processes and bookkeeping. The results are printed, or written to
+--output, as JSON."""
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import statistics
+import sys
+import time
+from threading import Thread
+from . import Pipeline
+from .pipeline import _Pipeline
+
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+SCENARIOS = ("throughput", "variants", "messaging", "latency")
+
+_destinations = itertools.count()
+
+
+def plain_task(item):
+    return item
+
+
+def generator_task(item):
+    yield item
+
+
+def setup_state():
+    return {"items": 0}
+
+
+def persistent_task(item, process_persistent):
+    process_persistent["items"] += 1
+    return item
+
+
+def forward_task(item, destination):
+    Pipeline.send(destination, item)
+
+
+def _timed(run, repeat):
+    """Calls run() repeat times and summarizes how long it took each time."""
+    runs = [run() for x in range(repeat)]
+    seconds = [x["seconds"] for x in runs]
+    summary = dict(runs[0], seconds=statistics.median(seconds), best_seconds=min(seconds), runs=seconds)
+    if "items" in summary:
+        summary["items_per_second"] = summary["items"] / summary["seconds"]
+        summary["us_per_item"] = summary["seconds"] * 1e6 / summary["items"]
+    return summary
+
+
+def _feed(pipeline, items, chunk_size, payload):
+    # Items are lists, since tuples would be passed as several arguments
+    for first in range(0, items, chunk_size):
+        pipeline.feed_chunk([[x, payload] for x in range(first, min(items, first + chunk_size))])
+
+
+def _feed_and_drain(pipeline, items, chunk_size, payload):
+    """Feeds items chunk by chunk from another thread, while reading the results back. Returns the number of
+    results."""
+    feeder = Thread(target=lambda: [_feed(pipeline, items, chunk_size, payload), pipeline.join()])
+    feeder.start()
+    results = sum(1 for x in pipeline.as_completed(join=False))
+    feeder.join()
+    return results
+
+
+def run_throughput(items, num, chunk_size, payload_bytes, generator=False, setup=False):
+    """Runs items through a single task of num workers, and times everything from start() to the last result."""
+    pipeline = _Pipeline()
+    if setup:
+        pipeline.add_task(persistent_task, num=num, chunk_size=chunk_size, setup=setup_state)
+    else:
+        pipeline.add_task(generator_task if generator else plain_task, num=num, chunk_size=chunk_size)
+    started = time.perf_counter()
+    pipeline.start()
+    results = _feed_and_drain(pipeline, items, chunk_size, b"x" * payload_bytes)
+    seconds = time.perf_counter() - started
+    assert results == items, "Got %d results for %d items" % (results, items)
+    return dict(num=num, chunk_size=chunk_size, payload_bytes=payload_bytes, generator=generator, setup=setup,
+                items=items, seconds=seconds)
+
+
+def run_messaging(items, num, chunk_size, payload_bytes):
+    """Times items sent with Pipeline.send, from the workers of one pipeline to another named pipeline."""
+    destination = "mpetl-bench-%d" % next(_destinations)
+    receiver = Pipeline(name=destination)
+    receiver.add_task(plain_task, num=num, chunk_size=chunk_size)
+    receiver.start()
+    sender = Pipeline()
+    sender.add_task(forward_task, num=num, destination=destination)
+    started = time.perf_counter()
+    sender.start()
+    _feed(sender, items, chunk_size, b"x" * payload_bytes)
+    sender.join()
+    results = sum(1 for x in receiver.as_completed())
+    seconds = time.perf_counter() - started
+    assert results == items, "Got %d results for %d items" % (results, items)
+    return dict(num=num, chunk_size=chunk_size, payload_bytes=payload_bytes, items=items, seconds=seconds)
+
+
+def run_latency(num):
+    """Times starting a pipeline of num workers, and joining it without feeding it anything."""
+    pipeline = _Pipeline()
+    pipeline.add_task(plain_task, num=num)
+    started = time.perf_counter()
+    pipeline.start()
+    running = time.perf_counter()
+    pipeline.join()
+    joined = time.perf_counter()
+    list(pipeline.as_completed())
+    return dict(num=num, start_seconds=running - started, join_seconds=joined - running, seconds=joined - started)
+
+
+def _environment():
+    try:
+        from importlib.metadata import version
+        mpetl_version = version("mpetl")
+    except Exception:
+        mpetl_version = None
+    return dict(mpetl=mpetl_version, python=platform.python_version(),
+                implementation=platform.python_implementation(), platform=platform.platform(),
+                cpu_count=multiprocessing.cpu_count(), start_method=multiprocessing.get_start_method(),
+                timestamp=time.time())
+
+
+def run(scenarios=SCENARIOS, items=20000, nums=(1, 4), chunk_sizes=(1, 100), payload_sizes=(16, 4096), repeat=3):
+    """Runs the given scenarios over every combination of their parameters, and returns a report with one entry per
+    combination."""
+    results = []
+    if "throughput" in scenarios:
+        for num, chunk_size, payload_bytes in itertools.product(nums, chunk_sizes, payload_sizes):
+            results.append(dict(scenario="throughput", **_timed(
+                lambda: run_throughput(items, num, chunk_size, payload_bytes), repeat)))
+    if "variants" in scenarios:
+        # Generator tasks and tasks with setup, compared to a plain task with the same settings
+        for generator, setup in ((False, False), (True, False), (False, True)):
+            results.append(dict(scenario="variants", **_timed(
+                lambda: run_throughput(items, nums[-1], chunk_sizes[-1], payload_sizes[0], generator, setup),
+                repeat)))
+    if "messaging" in scenarios:
+        for num, payload_bytes in itertools.product(nums, payload_sizes):
+            results.append(dict(scenario="messaging", **_timed(
+                lambda: run_messaging(items, num, chunk_sizes[-1], payload_bytes), repeat)))
+    if "latency" in scenarios:
+        for num in nums:
+            results.append(dict(scenario="latency", **_timed(lambda: run_latency(num), repeat)))
+    return dict(environment=_environment(), results=results)
+
+
+def _numbers(text):
+    return tuple(int(x) for x in text.split(","))
+
+
+def _names(text):
+    names = tuple(text.split(","))
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        raise argparse.ArgumentTypeError("unknown scenarios: %s" % ", ".join(sorted(unknown)))
+    return names
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m mpetl.bench", description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", type=_names, default=SCENARIOS,
+                        help="comma-separated scenarios to run, out of %s (default: all)" % ", ".join(SCENARIOS))
+    parser.add_argument("--items", type=int, default=20000, help="items per run (default: %(default)s)")
+    parser.add_argument("--nums", type=_numbers, default=(1, 4),
+                        help="comma-separated numbers of workers (default: 1,4)")
+    parser.add_argument("--chunk-sizes", type=_numbers, default=(1, 100),
+                        help="comma-separated chunk sizes (default: 1,100)")
+    parser.add_argument("--payload-sizes", type=_numbers, default=(16, 4096),
+                        help="comma-separated payload sizes in bytes (default: 16,4096)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of every combination, of which the median is reported (default: %(default)s)")
+    parser.add_argument("--output", help="file to write the JSON report to (default: standard output)")
+    args = parser.parse_args(argv)
+
+    report = run(args.scenarios, args.items, args.nums, args.chunk_sizes, args.payload_sizes, args.repeat)
+    report["arguments"] = vars(args)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
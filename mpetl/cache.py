@@ -0,0 +1,79 @@
+import hashlib
+import pickle
+import sqlite3
+import time
+
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,
+                                    used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS results_by_use ON results (used);
+CREATE TABLE IF NOT EXISTS total (bytes INTEGER NOT NULL);
+INSERT INTO total SELECT 0 WHERE NOT EXISTS (SELECT * FROM total);
+CREATE TRIGGER IF NOT EXISTS result_added AFTER INSERT ON results
+    BEGIN UPDATE total SET bytes = bytes + new.size; END;
+CREATE TRIGGER IF NOT EXISTS result_evicted AFTER DELETE ON results
+    BEGIN UPDATE total SET bytes = bytes - old.size; END;
+COMMIT;
+"""
+
+# A hit only marks its entry as recently used if it wasn't marked in the last this many seconds, so that reading the
+# same entries over and over doesn't turn every read into a write.
+_USE_RESOLUTION = 1.0
+
+
+class CacheSpec(object):
+    """Where a task keeps the results of its callable (an SQLite database at path, shared by all of its workers and by
+    later runs) and how large the pickled results may get in total before the least recently used are evicted. A
+    max_bytes of None never evicts anything."""
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def open(self, identity):
+        return _ResultCache(self, identity)
+
+
+class _ResultCache(object):
+    """One worker thread's connection to a task's cache. Results are looked up by a hash of the pickled item together
+    with the task's identity: its callable's qualified name and keyword arguments."""
+
+    def __init__(self, spec, identity):
+        self._max_bytes = spec.max_bytes
+        self._identity = pickle.dumps(identity, pickle.HIGHEST_PROTOCOL)
+        self._db = sqlite3.connect(spec.path, timeout=60, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+
+    def _key(self, item):
+        digest = hashlib.sha256(self._identity)
+        digest.update(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+        return digest.digest()
+
+    def call(self, call, item, kwargs):
+        """Returns the results of call(item, kwargs), from the cache if they're in it."""
+        key = self._key(item)
+        now = time.time()
+        row = self._db.execute("SELECT value, used FROM results WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            if now - row[1] > _USE_RESOLUTION:
+                self._db.execute("UPDATE results SET used = ? WHERE key = ?", (now, key))
+            return pickle.loads(row[0])
+
+        results = list(call(item, kwargs))
+        value = pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+        # Another worker may have just stored the same results, which is fine
+        self._db.execute("INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?)", (key, value, len(value), now))
+        if self._max_bytes is not None:
+            self._evict()
+        return results
+
+    def _evict(self):
+        while self._db.execute("SELECT bytes FROM total").fetchone()[0] > self._max_bytes:
+            self._db.execute("DELETE FROM results WHERE key = (SELECT key FROM results ORDER BY used LIMIT 1)")
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,64 @@
+import os
+import threading
+
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+
+class Checkpoint(object):
+    """Records which of the chunks fed to a pipeline have come all the way out of it, in an append-only file with one
+    chunk number per line. Chunks are numbered in the order they're fed, starting at 0, so a pipeline that's fed the
+    same input in the same order after a crash can skip the chunks the file lists (see done()).
+
+    A chunk is only recorded once every result of every item in it has been read from as_completed, so a chunk that
+    was partly processed when the job died is processed again in full."""
+
+    def __init__(self, path):
+        self._path = path
+        self._done = set()
+        if os.path.exists(path):
+            with open(path, "rb+") as f:
+                recorded = f.read()
+                # A crash can leave half a line at the end, which the next number mustn't be appended to
+                complete = recorded.rfind(b"\n") + 1
+                f.truncate(complete)
+            self._done.update(int(x) for x in recorded[:complete].split())
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+        # Items of chunks that are still in the pipeline: their chunk's number, and how many items each chunk has left
+        self._chunk_of = {}
+        self._remaining = {}
+
+    def done(self, chunk_num):
+        """Whether the chunk was already recorded, in this run or a previous one."""
+        return chunk_num in self._done
+
+    def fed(self, chunk_num, first_item, num_items):
+        """Notes that the chunk went in, as the items numbered first_item to first_item + num_items - 1."""
+        with self._lock:
+            if num_items == 0:
+                self._record(chunk_num)
+                return
+            self._remaining[chunk_num] = num_items
+            for item in range(first_item, first_item + num_items):
+                self._chunk_of[item] = chunk_num
+
+    def item_done(self, item):
+        """Notes that every result of the numbered item has been read."""
+        with self._lock:
+            chunk_num = self._chunk_of.pop(item)
+            self._remaining[chunk_num] -= 1
+            if self._remaining[chunk_num] == 0:
+                del self._remaining[chunk_num]
+                self._record(chunk_num)
+
+    def _record(self, chunk_num):
+        self._done.add(chunk_num)
+        self._file.write("%d\n" % chunk_num)
+        self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            os.fsync(self._file.fileno())
+            self._file.close()
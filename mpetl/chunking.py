@@ -0,0 +1,55 @@
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+
+class AutoChunk(object):
+    """Adaptive chunk size policy. Pass it (or just the string "auto") as a task's chunk_size.
+
+    Every worker measures how long it takes to compute each outgoing item and how long each put() on the output queue
+    takes, and sizes its next chunk so that producing and sending it takes about target seconds. Chunk sizes always
+    stay between min_size and max_size."""
+
+    def __init__(self, target=0.02, min_size=1, max_size=10000, smoothing=0.3):
+        if min_size < 1 or max_size < min_size:
+            raise ValueError("AutoChunk needs 1 <= min_size <= max_size.")
+        self.target = target
+        self.min_size = min_size
+        self.max_size = max_size
+        self.smoothing = smoothing
+
+    def sizer(self):
+        return _ChunkSizer(self)
+
+    def __repr__(self):
+        return "AutoChunk(target=%r, min_size=%r, max_size=%r)" % (self.target, self.min_size, self.max_size)
+
+
+class _ChunkSizer(object):
+    """Per-worker state for an AutoChunk policy."""
+
+    def __init__(self, policy):
+        self._policy = policy
+        self._item_time = None
+        self._put_time = None
+        self.size = policy.min_size
+
+    def _smooth(self, average, sample):
+        if average is None:
+            return sample
+        return average + self._policy.smoothing * (sample - average)
+
+    def observe(self, compute_time, items, put_time):
+        """Records one chunk of items that took compute_time seconds to produce and put_time seconds to put, and
+        returns the size the next chunk should have."""
+        policy = self._policy
+        self._item_time = self._smooth(self._item_time, compute_time / items)
+        self._put_time = self._smooth(self._put_time, put_time)
+
+        if self._item_time <= 0:
+            wanted = policy.max_size
+        else:
+            wanted = (policy.target - self._put_time) / self._item_time
+
+        # Don't grow more than twice as large per chunk, so a few unrepresentative items can't send the size flying.
+        wanted = min(wanted, self.size * 2)
+        self.size = int(max(policy.min_size, min(policy.max_size, wanted)))
+        return self.size
@@ -0,0 +1,198 @@
+import itertools
+import os
+import pickle
+import queue
+import threading
+import weakref
+from multiprocessing.managers import BaseManager
+from .util import SENTINEL, dprint, marker_environment
+
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+# The coordinator's state. It lives in the coordinator's server process, and everyone else reaches it over TCP.
+_control = None
+
+
+class _Control(object):
+    """Keeps the queues of the pipelines that run on a Coordinator, hands out their workers' jobs to agents, and notes
+    when those are done."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._next_id = itertools.count()
+        self._jobs = queue.Queue()
+        self._done = {}
+        self._slots = 0
+
+    def create_queue(self, max_size):
+        with self._lock:
+            name = next(self._next_id)
+            self._queues[name] = queue.Queue(max(max_size, 0))
+        return name
+
+    def delete_queue(self, name):
+        with self._lock:
+            self._queues.pop(name, None)
+
+    # Every queue is reached through the control object, since each proxy of its own would cost a connection
+
+    def put(self, name, obj, block=True, timeout=None):
+        self._queues[name].put(obj, block, timeout)
+
+    def get(self, name, block=True, timeout=None):
+        return self._queues[name].get(block, timeout)
+
+    def qsize(self, name):
+        return self._queues[name].qsize()
+
+    def submit(self, job):
+        """Queues up a worker's job (a pickled task, the names of its input and output queues, and its worker
+        number) for the next free agent slot. Returns the job's number."""
+        with self._lock:
+            job_id = next(self._next_id)
+            self._done[job_id] = threading.Event()
+        self._jobs.put((job_id, job))
+        return job_id
+
+    def hello(self, slots):
+        """Called by every agent that connects, with the number of jobs it runs at the same time. Returns the
+        environment variables that hold the coordinator's markers, which its workers have to use too."""
+        with self._lock:
+            self._slots += slots
+        return marker_environment()
+
+    def next_job(self):
+        """Waits for a job for an agent slot. Returns SENTINEL when the coordinator is closing."""
+        return self._jobs.get()
+
+    def finished(self, job_id, exit_code):
+        if exit_code != 0:
+            dprint("Job", job_id, "ended with exit code", exit_code)
+        self._done[job_id].set()
+
+    def wait(self, job_id, timeout=None):
+        """Whether the job is done, waiting up to timeout seconds for it to be."""
+        return self._done[job_id].wait(timeout)
+
+    def stop(self):
+        """Tells every agent slot to finish."""
+        with self._lock:
+            slots, self._slots = self._slots, 0
+        for x in range(slots):
+            self._jobs.put(SENTINEL)
+
+
+def _get_control():
+    global _control
+    if _control is None:
+        _control = _Control()
+    return _control
+
+
+class _CoordinatorManager(BaseManager):
+    pass
+
+
+_CoordinatorManager.register("control", callable=_get_control)
+
+
+def connect(address, authkey):
+    """Connects to a running Coordinator. Returns a manager whose control() gives access to it."""
+    manager = _CoordinatorManager(address, authkey)
+    manager.connect()
+    return manager
+
+
+class Coordinator(object):
+    """Runs the workers of pipelines on other machines. Its server process listens on address for agents (started
+    with `python -m mpetl.worker host:port`), which take the workers' jobs as they have room for them and run each one
+    in a process of its own, and it holds the queues between the stages: every chunk a remote worker gets or puts is a
+    round trip to the coordinator. Agents prove they may connect with authkey, which is generated if not given.
+
+    A pipeline created with coordinator=... creates its queues in the coordinator, bounded by its max_size, and has
+    the coordinator hand one job per worker process to its agents. The tasks' callables have to be importable by the
+    agents, under the same module names."""
+
+    def __init__(self, address=("127.0.0.1", 0), authkey=None):
+        self._authkey = os.urandom(16).hex().encode() if authkey is None else authkey
+        self._manager = _CoordinatorManager(address, self._authkey)
+        self._manager.start()
+        self._control = self._manager.control()
+        self._finalize = weakref.finalize(self, Coordinator._shutdown, self._control, self._manager)
+
+    @property
+    def address(self):
+        return self._manager.address
+
+    @property
+    def authkey(self):
+        return self._authkey
+
+    def create_queues(self, num, max_size=-1):
+        """Creates num queues of at most max_size chunks each, for a pipeline's stages."""
+        return [_RemoteQueue(self._control, self._control.create_queue(max_size)) for x in range(num)]
+
+    def release_queues(self, queues):
+        for q in queues:
+            self._control.delete_queue(q.name)
+
+    def run(self, task, input, output, worker_num):
+        """Has an agent run task's worker loop between the queues input and output. Returns a handle that can be
+        joined like a Process."""
+        job = pickle.dumps((task, input.name, output.name, worker_num), pickle.HIGHEST_PROTOCOL)
+        return _RemoteJob(self._control, self._control.submit(job))
+
+    def close(self):
+        """Tells the agents to finish, and stops the server process."""
+        self._finalize()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _shutdown(control, manager):
+        control.stop()
+        manager.shutdown()
+
+
+class _RemoteQueue(object):
+    """A queue in the coordinator, as seen from the pipeline's process or from a worker on an agent."""
+
+    def __init__(self, control, name):
+        self.name = name
+        self._control = control
+
+    def put(self, obj, block=True, timeout=None):
+        self._control.put(self.name, obj, block, timeout)
+
+    def get(self, block=True, timeout=None):
+        return self._control.get(self.name, block, timeout)
+
+    def qsize(self):
+        return self._control.qsize(self.name)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def close(self):
+        pass
+
+
+class _RemoteJob(object):
+    """One worker running on an agent. Quacks like the Process it replaces."""
+
+    def __init__(self, control, job_id):
+        self._control = control
+        self._job_id = job_id
+
+    def is_alive(self):
+        return not self._control.wait(self._job_id, 0)
+
+    def join(self):
+        # Waits a second at a time, so that the pipeline's process can still be interrupted
+        while not self._control.wait(self._job_id, 1):
+            pass
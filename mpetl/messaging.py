@@ -1,31 +1,169 @@
 __author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
 
 import multiprocessing
+import multiprocessing.util
+import os
+import queue
 import threading
+import time
 import collections
 import logging
 import traceback
 import weakref
 from .util import SENTINEL, _random_string, dprint
+from .transport import OUT_OF_BAND_THRESHOLD, dumps, loads, discard
 
 pipeline_message = collections.namedtuple("pipeline_message", ["destination", "data"])
 registration_message = collections.namedtuple("registration_message", ["name", "queue"])
 goodbye_message = collections.namedtuple("goodbye_message", ["name"])
+flush_message = collections.namedtuple("flush_message", ["name"])
+# Answered by the central receiver once it has routed everything that came before it.
+sync_message = collections.namedtuple("sync_message", ["reply"])
 
+# MessagingCenters that this process has sent (or buffered) messages through since it last settled them (see settle), and whether
+# this process relays every message through the MessagingCenter, even to pipelines registered for direct routing.
+_unsettled = weakref.WeakSet()
+_relay_only = False
+# What Pipeline.send uses in workers started with spawn or forkserver (see set_worker_sender).
+_worker_sender = None
 
-class MessagingCenter(multiprocessing.Process):
+
+def _forget_unsettled():
+    # Forked processes haven't sent anything yet
+    _unsettled.clear()
+
+
+os.register_at_fork(after_in_child=_forget_unsettled)
+
+
+def relay_only():
+    """Has this process relay every message through the MessagingCenter, so that settle() covers all of them. For
+    processes that outlive the tasks they run (i.e. WorkerPool workers)."""
+    global _relay_only
+    _relay_only = True
+
+
+def settle():
+    """Settles what this process sent through every MessagingCenter (see MessagingCenter.settle)."""
+    for center in list(_unsettled):
+        center.settle()
+
+
+def set_worker_sender(sender):
+    """Has Pipeline.send use sender in this process, which is a worker that didn't inherit the MessagingCenter."""
+    global _worker_sender
+    _worker_sender = sender
+
+
+def worker_sender():
+    """The sender given to set_worker_sender, if this process got one."""
+    return _worker_sender
+
+
+class _Sender(object):
+    """The sending half of a MessagingCenter: it coalesces what this process sends to each destination and puts it in
+    the MessagingCenter's queue, or straight into the destination's input queue for pipelines registered for direct
+    routing. Workers started with spawn or forkserver don't inherit the MessagingCenter, so they get one of these
+    instead (see MessagingCenter.sender)."""
+
+    def __init__(self, incoming, routes, oob_threshold, batch_size, linger):
+        self._incoming = incoming
+        self._routes = routes
+        self._oob_threshold = oob_threshold
+        self._batch_size = batch_size
+        self._linger = linger
+        # Send buffers, by destination, and the process they belong to; see _send_buffers.
+        self._buffers_pid = None
+        self._buffers = None
+        self._buffers_lock = None
+
+    def send_message(self, name, data):
+        """Sends a list of items to the pipeline called name."""
+        _unsettled.add(self)
+        if self._batch_size <= 1:
+            self._deliver(name, data)
+            return
+        buffers = self._send_buffers()
+        with self._buffers_lock:
+            started, items = buffers.setdefault(name, (time.monotonic(), []))
+            items.extend(data)
+            if len(items) >= self._batch_size:
+                del buffers[name]
+                self._deliver(name, items)
+
+    def _deliver(self, name, data):
+        route = self._routes.get(name)
+        if route is not None and not _relay_only:
+            route.put(data)
+            return
+        self._incoming.put(pipeline_message(name, dumps(data, self._oob_threshold)[0]))
+
+    def _send_buffers(self):
+        """Returns this process' send buffers. A forked process starts with empty ones of its own, a thread that sends
+        them when they linger, and a finalizer that sends them when it exits."""
+        if self._buffers_pid != os.getpid():
+            self._buffers_pid = os.getpid()
+            self._buffers = {}
+            self._buffers_lock = threading.Lock()
+            threading.Thread(target=self._send_lingering, daemon=True).start()
+            # Higher priority than the multiprocessing.Queue finalizers, which stop their feeder threads.
+            multiprocessing.util.Finalize(self, self.drain, exitpriority=20)
+        return self._buffers
+
+    def _send_lingering(self):
+        while True:
+            time.sleep(self._linger)
+            deadline = time.monotonic() - self._linger
+            with self._buffers_lock:
+                for name in [name for name, (started, items) in self._buffers.items() if started <= deadline]:
+                    self._deliver(name, self._buffers.pop(name)[1])
+
+    def drain(self):
+        """Sends everything this process has buffered."""
+        if self._buffers_pid != os.getpid():
+            return
+        with self._buffers_lock:
+            for name, (started, items) in self._buffers.items():
+                self._deliver(name, items)
+            self._buffers.clear()
+
+
+class MessagingCenter(multiprocessing.Process, _Sender):
+    """Routes messages between pipelines. A message goes from the sender to this process, then to a listener thread in
+    the destination pipeline's process, then into the pipeline's input queue. Messages are pickled once by the sender
+    (see mpetl.transport.dumps), so buffers of at least oob_threshold bytes travel through shared memory instead of
+    being copied at every hop, and only the listener unpickles them.
+
+    Pipelines registered with direct=True skip all of that: processes forked after the registration (which includes
+    the workers of every pipeline started later, unless they're spawned) put their messages straight into the
+    destination's input queue. Anyone else still goes through this process.
+
+    Either way, every process coalesces what it sends to each destination: items are buffered and sent as one chunk
+    once there are batch_size of them, or once the oldest has waited for linger seconds. Buffers are also sent when
+    the process exits and when it calls flush(). A batch_size of 1 sends every message right away."""
     _queue_manager = None
     _queue_manager_lock = None
 
-    def __init__(self):
+    def __init__(self, oob_threshold=OUT_OF_BAND_THRESHOLD, batch_size=1000, linger=0.01):
         multiprocessing.Process.__init__(self)
+        # The input queues of the pipelines registered for direct routing, by name, are the routes. Forked processes
+        # inherit them.
+        _Sender.__init__(self, multiprocessing.Queue(), weakref.WeakValueDictionary(), oob_threshold, batch_size,
+                         linger)
         self._known_pipelines = {}
-        self._incoming = multiprocessing.Queue()
         self.daemon = True
         if MessagingCenter._queue_manager is None:
             MessagingCenter._queue_manager = multiprocessing.Manager()
             MessagingCenter._queue_manager_lock = multiprocessing.Lock()
             # MessagingCenter._queue_manager.start()
+        # Listener threads started by this process, by pipeline name, and where they acknowledge flush messages.
+        self._listeners = {}
+        self._flush_acks = queue.Queue()
+        # Where workers started with spawn or forkserver send their messages, and the process whose thread forwards
+        # them (see sender).
+        self._spawned_incoming = None
+        self._forwarder_pid = None
+        self._forwarded = None
         self._finalizer = weakref.finalize(self, MessagingCenter._cleanup, self._known_pipelines)
         dprint("Finished setting up messaging center.")
 
@@ -42,13 +180,16 @@ class MessagingCenter(multiprocessing.Process):
                     self._close_outgoing()
                     break
 
-                if isinstance(msg, registration_message):
+                if isinstance(msg, sync_message):
+                    msg.reply.put(True)
+                elif isinstance(msg, registration_message):
                     self._known_pipelines[msg.name] = msg.queue
                 elif isinstance(msg, pipeline_message):
                     if self._known_pipelines[msg.destination] is not None:
                         self._known_pipelines[msg.destination].put(msg.data)
                     else:
                         logging.warning("Received message %r for a closed pipeline.", msg)
+                        discard(msg.data)
                 elif isinstance(msg, goodbye_message):
                     if self._known_pipelines[msg.name] is not None:
                         self._known_pipelines[msg.name].put(SENTINEL)
@@ -68,34 +209,83 @@ class MessagingCenter(multiprocessing.Process):
         return return_queue
 
     @staticmethod
-    def receive_message_in_process(internal_queue, queue):
+    def receive_message_in_process(internal_queue, queue, acks=None):
         try:
             while True:
                 item = internal_queue.get()
                 if item == SENTINEL:
                     break
+                if isinstance(item, flush_message):
+                    # Everything that came before this message has been forwarded.
+                    if acks is not None:
+                        acks.put(item.name)
+                    continue
                 if queue() is not None:
-                    queue().put(item)
+                    queue().put(loads(item))
+                else:
+                    discard(item)
         except EOFError:
             return
 
-    def send_message(self, name, data):
-        self._incoming.put(pipeline_message(name, data))
+    def sender(self):
+        """Returns what a worker started with spawn or forkserver needs to send messages through this MessagingCenter.
+        Queues made for forked processes can't be handed to those, so their messages go to a queue of the queue
+        manager instead, and a thread in this process forwards them; they can't use direct routing."""
+        if self._forwarder_pid != os.getpid():
+            with MessagingCenter._queue_manager_lock:
+                self._spawned_incoming = self._queue_manager.Queue()
+            self._forwarder_pid = os.getpid()
+            self._forwarded = queue.Queue()
+            threading.Thread(target=self._forward_spawned, args=(self._spawned_incoming, self._forwarded),
+                             daemon=True).start()
+        return _Sender(self._spawned_incoming, {}, self._oob_threshold, self._batch_size, self._linger)
+
+    def _forward_spawned(self, spawned_incoming, forwarded):
+        try:
+            while True:
+                msg = spawned_incoming.get()
+                if isinstance(msg, flush_message):
+                    # Everything that came before this message has been forwarded.
+                    forwarded.put(msg.name)
+                else:
+                    self._incoming.put(msg)
+        except (EOFError, OSError):
+            return
 
-    def register_pipeline_queue(self, name, queue):
-        """Starts a background daemonic thread that receives messages and places them in the designated queue."""
+    def settle(self):
+        """Sends everything this process has buffered, and waits until the central receiver has routed everything
+        this process sent it. Puts on the way to it are finished by a feeder thread, so without this, a flush() from
+        another process could overtake them. Processes that exit after their task don't need this; their queues
+        finish their puts on the way out."""
+        self.drain()
+        if self not in _unsettled:
+            return
+        _unsettled.discard(self)
+        with MessagingCenter._queue_manager_lock:
+            reply = self._queue_manager.Queue()
+        self._incoming.put(sync_message(reply))
+        reply.get()
+
+    def register_pipeline_queue(self, name, queue, direct=False):
+        """Starts a background daemonic thread that receives messages and places them in the designated queue. If
+        direct is True, processes that know about the queue (this one, and those it starts from now on) put their
+        messages into it themselves."""
+        if direct:
+            self._routes[name] = queue
         # Register with the central repository and receive a port number
         internal_queue = self.create_incoming_queue(name)
         new_listener = threading.Thread(target=self.receive_message_in_process,
-                                        args=(internal_queue, weakref.ref(queue)),
+                                        args=(internal_queue, weakref.ref(queue), self._flush_acks),
                                         daemon=True)
         new_listener.start()
+        self._listeners[name] = (internal_queue, new_listener)
         return
 
     def register_pipeline(self, name, pipeline):
         self.register_pipeline_queue(name, pipeline.input_queue)
 
     def forget_pipeline(self, name):
+        self._routes.pop(name, None)
         self._incoming.put(goodbye_message(name))
 
     def run(self):
@@ -106,11 +296,32 @@ class MessagingCenter(multiprocessing.Process):
         one specific message."""
         queue_name = '__*($#^%' + _random_string()
         temp_queue = multiprocessing.Queue()
+        self.drain()
+        if self._forwarder_pid == os.getpid():
+            self._spawned_incoming.put(flush_message(queue_name))
+            self._forwarded.get()
         self.register_pipeline_queue(queue_name, temp_queue)
-        self.send_message(queue_name, 0)
+        self._deliver(queue_name, 0)
         temp_queue.get()
         temp_queue.close()
         self.forget_pipeline(queue_name)
+        del self._listeners[queue_name]
+        self._wait_for_listeners()
+
+    def _wait_for_listeners(self):
+        """Waits until this process' listener threads have forwarded every message they had received so far. The
+        central receiver has already routed all of them, so a flush message placed behind them marks the end."""
+        pending = {}
+        for name, (internal_queue, listener) in self._listeners.items():
+            if listener.is_alive():
+                internal_queue.put(flush_message(name))
+                pending[name] = listener
+        while len(pending) > 0:
+            try:
+                pending.pop(self._flush_acks.get(timeout=0.1), None)
+            except queue.Empty:
+                # Listeners of forgotten pipelines end without acknowledging anything.
+                pending = {name: listener for name, listener in pending.items() if listener.is_alive()}
 
     @staticmethod
     def _cleanup(pipelines):
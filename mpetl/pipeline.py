@@ -1,10 +1,23 @@
+import asyncio
+import functools
 import inspect
 import multiprocessing
+import os
+import shutil
+import tempfile
 import traceback
 import sys
+import time
+import uuid
 import weakref
-from threading import Thread
-from .util import SENTINEL, dprint
+from threading import Thread, BoundedSemaphore, Lock
+from .util import SENTINEL, RETIRE, NOTHING, dprint
+from .checkpoint import Checkpoint
+from .transport import _PartitionedQueue, _PerWorkerQueues, _StealingQueue, make_queue
+from .chunking import AutoChunk
+from .stats import StageStats
+from .autoscale import Autoscaler
+from . import messaging, profiling
 
 __author__ = 'Jorge R. Herskovic <jherskovic@mdanderson.org>'
 
@@ -13,110 +26,785 @@ class SequenceError(Exception):
     pass
 
 
+class _OutgoingChunks(object):
+    """Gathers the results of one worker into chunks and puts them in its output queue. It also keeps the worker's
+    clock: how long it spends busy (i.e. neither waiting for input nor putting output), waiting, and putting. The
+    AutoChunk policy, if any, uses those times to size the following chunks, and they're recorded in the worker's
+    stats if it has them."""
+
+    def __init__(self, output, chunk_size, stats=None):
+        self._output = output
+        self._sizer = chunk_size.sizer() if isinstance(chunk_size, AutoChunk) else None
+        self._chunk_size = chunk_size if self._sizer is None else self._sizer.size
+        self._stats = stats
+        self._chunk = []
+        self._compute_time = 0.0
+        self._mark = self._item_mark = time.perf_counter()
+
+    @property
+    def timed(self):
+        """Whether the worker should call item_done() after every item."""
+        return self._stats is not None
+
+    def _busy(self, elapsed):
+        self._compute_time += elapsed
+        if self._stats is not None:
+            self._stats.busy(elapsed)
+
+    def pause(self):
+        """Stops the busy clock, e.g. while waiting for input."""
+        now = time.perf_counter()
+        self._busy(now - self._mark)
+        self._mark = now
+        if self._stats is not None:
+            self._stats.publish()
+
+    def resume(self, received=None):
+        """Restarts the busy clock after waiting for input; received is the chunk that arrived, if any."""
+        now = time.perf_counter()
+        if self._stats is not None:
+            if received is None:
+                self._stats.waited(now - self._mark)
+                self._stats.publish()
+            else:
+                self._stats.received(len(received), now - self._mark)
+                self._stats.started()
+        self._mark = self._item_mark = now
+
+    def item_done(self, count=1):
+        """Records that the worker finished count items since the previous call (or since the chunk arrived)."""
+        now = time.perf_counter()
+        self._stats.item_done((now - self._item_mark) / count, count)
+        self._item_mark = now
+
+    def item_took(self, latency):
+        """Records one item that took latency seconds, for workers that have several items in flight at once."""
+        self._stats.item_done(latency)
+
+    def append(self, result):
+        self._chunk.append(result)
+        if len(self._chunk) >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._chunk) == 0:
+            return
+
+        self.pause()
+        if self._output() is not None:
+            self._output().put(self._chunk)
+        now = time.perf_counter()
+        put_time = now - self._mark
+        self._mark = now
+
+        if self._stats is not None:
+            self._stats.sent(len(self._chunk), put_time)
+            self._stats.started()
+        if self._sizer is not None:
+            self._chunk_size = self._sizer.observe(self._compute_time, len(self._chunk), put_time)
+        self._compute_time = 0.0
+        self._chunk = []
+
+    def finish(self):
+        """Puts the last, partial chunk and publishes the worker's final counters."""
+        self.flush()
+        if self._stats is not None:
+            self._stats.publish()
+
+
+def _keyed_results(key, results):
+    """Pairs each result of an item with its key in an ordered pipeline: the item's key plus the result's index and
+    whether it's the item's last result. An item without results leaves a NOTHING behind, so that the results can be
+    put back in order without waiting for it."""
+    results = iter(results)
+    try:
+        current = next(results)
+    except StopIteration:
+        yield key + ((0, True),), NOTHING
+        return
+    index = 0
+    for following in results:
+        yield key + ((index, False),), current
+        current = following
+        index += 1
+    yield key + ((index, True),), current
+
+
+class _ReorderBuffer(object):
+    """Puts the results of an ordered pipeline back in the order of the items they came from. Keys start with the
+    item's sequence number, followed by one (index, last) pair per stage; the result that comes right after a given one
+    is the next sibling at the deepest stage where it wasn't the last, or the first result of the next item."""
+
+    def __init__(self, stages, window=None):
+        # The first result has the first sequence number and is the first at every stage
+        self._next = (0,) * (stages + 1)
+        self._waiting = {}
+        self._window = window
+
+    def add(self, key, value):
+        self._waiting[(key[0],) + tuple(index for index, last in key[1:])] = (key, value)
+
+    def ready(self):
+        """Yields the (key, result) pairs that are next in line, including NOTHINGs."""
+        while self._next in self._waiting:
+            key, value = self._waiting.pop(self._next)
+            self._next = self._after(key)
+            yield key, value
+
+    def _after(self, key):
+        for stage in range(len(key) - 1, 0, -1):
+            index, last = key[stage]
+            if not last:
+                return (key[0],) + tuple(i for i, l in key[1:stage]) + (index + 1,) + (0,) * (len(key) - 1 - stage)
+        # That was the item's last result
+        if self._window is not None:
+            self._window.release()
+        return (key[0] + 1,) + (0,) * (len(key) - 1)
+
+
+class _CompletionTracker(object):
+    """Tells, from the keys of the results of an ordered or checkpointed pipeline (see _keyed_results), when the last
+    result of each item is in, whatever order they arrive in. Every result is a leaf in its item's tree of results, and
+    a node of that tree is complete once it has as many complete children as its last child's index plus one."""
+
+    def __init__(self):
+        # Incomplete nodes: how many of their children are complete, and how many there are (once the last one is in)
+        self._open = {}
+
+    def add(self, key):
+        """Takes the key of a result. Returns the item's sequence number if that was its last result, None otherwise."""
+        node = key
+        while len(node) > 1:
+            parent = node[:-1]
+            index, last = node[-1]
+            counts = self._open.setdefault(parent, [0, None])
+            counts[0] += 1
+            if last:
+                counts[1] = index + 1
+            if counts[0] != counts[1]:
+                return None
+            del self._open[parent]
+            node = parent
+        return node[0]
+
+
+class _EndCounter(object):
+    """Counts the end markers (SENTINELs) that reach one input queue of a task once the pipeline's input is closed.
+    Every worker upstream puts one in each queue it feeds when it's done, after everything else it put there, so by
+    the time the last expected marker is read, everything before it has been read too. Whoever reads it tells the other
+    readers of the queue to finish, with one RETIRE each."""
+
+    def __init__(self, expected, readers, context=multiprocessing):
+        self._expected = expected
+        self._readers = readers
+        self._seen = context.Value("i", 0)
+
+    def is_last(self, queue):
+        with self._seen.get_lock():
+            self._seen.value += 1
+            last = self._seen.value == self._expected
+        if last:
+            for x in range(self._readers - 1):
+                queue.put(RETIRE)
+        return last
+
+
+def _put_end(queue):
+    """Puts an end marker in the queue or, if each worker reading from it has a queue of its own, in every one."""
+    for q in queue.queues if isinstance(queue, _PerWorkerQueues) else (queue,):
+        q.put(SENTINEL)
+
+
+def _split_results(queues, keep_results):
+    """Splits a pipeline's borrowed queues into the ones to give back and the ones to keep."""
+    if keep_results:
+        return queues[:-1], queues[-1:]
+    return queues, []
+
+
+def _declared_parameters(callable):
+    try:
+        parameters = inspect.signature(callable).parameters.values()
+    except (TypeError, ValueError):
+        return set()
+    return set(p.name for p in parameters if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY))
+
+
+def _task_options(callable, kwargs):
+    """Takes the task options (the keyword arguments of _QTask._configure) out of kwargs and returns them. Unknown
+    keyword arguments are passed as-is to the callable, and so is any option whose name the callable declares as a
+    parameter of its own; that task then just can't use that option."""
+    declared = _declared_parameters(callable)
+    names = set(inspect.signature(_QTask._configure).parameters) - {"self"}
+    return {name: kwargs.pop(name) for name in list(kwargs) if name in names and name not in declared}
+
+
 class _QTask(object):
     """Describes one task in a _Pipeline."""
 
     def __init__(self, callable, num, chunk_size, setup, teardown, **kwargs):
         self._callable = callable
+        self._is_generator = inspect.isgeneratorfunction(callable)
+        self._is_async = inspect.iscoroutinefunction(callable) or inspect.isasyncgenfunction(callable)
         self._num = multiprocessing.cpu_count() if num is None or num < 1 else num
-        self._chunk_size = 1 if chunk_size is None or chunk_size < 1 else chunk_size
+        if chunk_size == "auto":
+            chunk_size = AutoChunk()
+        elif isinstance(chunk_size, str):
+            raise ValueError("chunk_size must be a number, 'auto' or an AutoChunk, not %r." % chunk_size)
+        if not isinstance(chunk_size, AutoChunk):
+            chunk_size = 1 if chunk_size is None or chunk_size < 1 else chunk_size
+        self._chunk_size = chunk_size
         self._setup = setup
         self._teardown = teardown
+        self._options = _task_options(callable, kwargs)
+        self._configure(**self._options)
         self._kwargs = kwargs
         self._processes = []
+        self._slots = {}
+        self._live_workers = 0
+        self._closed = False
+        self._stats = None
         self._input = None
         self._output = None
+        self._pool_state = None
+        self._context = multiprocessing
+        # The pipeline's profiling switch, and where this task's workers write what they profiled (see WorkerProfiler)
+        self._profiling = None
+        self._profile_prefix = None
+        # How workers started with spawn or forkserver send messages to named pipelines (see MessagingCenter.sender)
+        self._sender = None
+        # Set when the end of the input travels down from stage to stage (see _EndCounter): one counter per input
+        # queue, and the one this worker reads from.
+        self._end_counters = None
+        self._end_counter = None
+        # Set by ordered pipelines: items then come with their keys, and results leave with theirs (see _keyed_results).
+        self._ordered = False
+
+    def __getstate__(self):
+        """Tasks are pickled to start workers with the spawn and forkserver start methods, or to send them to a
+        WorkerPool. Only what describes the task goes along; the worker gets its queues and stats in attach()."""
+        state = dict(self.__dict__)
+        for name in ("_input", "_output", "_processes", "_slots", "_stats", "_context", "_profiling", "_sender"):
+            state[name] = None
+        return state
+
+    def _configure(self, transport=None, fuse=False, executor="process", threads=1, setup_scope="thread",
+                   concurrency=1, batch=False, min_num=None, max_num=None, partition_by=None, schedule="shared",
+                   max_bytes=None, cache=None):
+        """Sets the task's options. These are the keyword arguments of add_task and its siblings that configure the
+        task itself instead of going to the callable (see _task_options)."""
+        self._transport = transport
+        self._fuse = fuse
+        if executor not in ("process", "thread"):
+            raise ValueError("executor must be 'process' or 'thread', not %r." % executor)
+        if setup_scope not in ("process", "thread"):
+            raise ValueError("setup_scope must be 'process' or 'thread', not %r." % setup_scope)
+        self._executor = executor
+        self._threads = 1 if threads is None or threads < 1 else threads
+        self._setup_scope = setup_scope
+        self._concurrency = 1 if concurrency is None or concurrency < 1 else concurrency
+        if batch not in (False, True, "numpy"):
+            raise ValueError("batch must be False, True or 'numpy', not %r." % batch)
+        if batch and self._is_async:
+            raise ValueError("Coroutine tasks can't run in batch mode.")
+        self._batch = batch
+        if min_num is not None or max_num is not None:
+            if executor != "process" or self._threads != 1:
+                raise ValueError("Only tasks that run one thread per process can autoscale.")
+            self._min_num = 1 if min_num is None or min_num < 1 else min_num
+            self._max_num = multiprocessing.cpu_count() if max_num is None else max_num
+            if self._max_num < self._min_num:
+                raise ValueError("max_num can't be smaller than min_num.")
+            self._num = max(self._min_num, min(self._max_num, self._num))
+        else:
+            self._min_num = self._max_num = self._num
+        if partition_by is not None:
+            if executor != "process" or self._threads != 1 or self.autoscaling:
+                raise ValueError("Only tasks with a fixed number of processes, with one thread each, can be "
+                                 "partitioned.")
+        self._partition_by = partition_by
+        if schedule not in ("shared", "steal"):
+            raise ValueError("schedule must be 'shared' or 'steal', not %r." % schedule)
+        if schedule == "steal" and (executor != "process" or self.autoscaling or partition_by is not None):
+            raise ValueError("Only tasks with a fixed number of processes, and no partition_by, can steal work.")
+        self._schedule = schedule
+        self._max_bytes = max_bytes
+        if cache is not None and (batch or self._is_async):
+            raise ValueError("Only tasks that are called one item at a time can cache their results.")
+        self._cache = cache
+
+    @property
+    def name(self):
+        return self._callable.__name__
+
+    def _setup_worker(self):
+        """Runs the setup callable, if any, and returns the keyword arguments for the task's callable. In a WorkerPool,
+        the setup callable runs only once per worker process and its result is reused by every later task."""
+        if self._setup is None:
+            return self._kwargs
+        if self._pool_state is None:
+            return dict(self._kwargs, process_persistent=self._setup())
+        if self._setup not in self._pool_state:
+            self._pool_state[self._setup] = (self._setup(), self._teardown)
+        return dict(self._kwargs, process_persistent=self._pool_state[self._setup][0])
+
+    def _teardown_worker(self, kwargs):
+        # Pool workers tear down their persistent state when the pool is closed.
+        if self._teardown is not None and self._pool_state is None:
+            self._teardown(kwargs.get('process_persistent'))
+
+    def attach(self, input, output, stats=None, pool_state=None, profiling=None):
+        """Hooks up a task that a worker process just received to its queues, its stats, its profiling switch and,
+        in a WorkerPool, the worker's persistent state."""
+        self._input = weakref.ref(input)
+        self._output = weakref.ref(output)
+        self._stats = stats
+        self._pool_state = pool_state
+        self._profiling = profiling
+
+    @property
+    def _has_own_queues(self):
+        """Whether each worker process reads from an input queue of its own (see _PerWorkerQueues)."""
+        return self._partition_by is not None or self._schedule == "steal"
+
+    @property
+    def pool_workers_needed(self):
+        """Number of WorkerPool workers the task would take up."""
+        return 0 if self._executor == "thread" else self._num
+
+    def _call(self, item, kwargs):
+        """Calls the task's callable on one item and returns an iterable over its results."""
+        if isinstance(item, tuple):
+            result = self._callable(*item, **kwargs)
+        else:
+            result = self._callable(item, **kwargs)
+
+        if self._is_generator:
+            return result
+        # Valueless function, or no result whatsoever.
+        return () if result is None else (result,)
+
+    def _call_ordered(self, keyed_item, kwargs, call=None):
+        """Like _call (or the given call), for ordered pipelines: takes a (key, item) pair and returns (key, result)
+        pairs."""
+        key, item = keyed_item
+        if isinstance(item, str) and item == NOTHING:
+            return ((key + ((0, True),), NOTHING),)
+        return _keyed_results(key, (call or self._call)(item, kwargs))
+
+    def _identity(self):
+        """What a cached result depends on besides the item: the callable's qualified name and keyword arguments."""
+        return (self._callable.__module__, self._callable.__qualname__, sorted(self._kwargs.items()))
+
+    @property
+    def _threads_per_unit(self):
+        """Number of worker threads in each process (or, for the thread executor, in the pipeline's process)."""
+        if self._executor == "thread":
+            return self._num * self._threads
+        return self._threads
 
     def _run_in_process(self, process_num=0):
-        my_name = self._callable.__name__ + str(process_num)
+        """Runs the worker loop in as many threads as each process needs. With setup_scope="process", setup and
+        teardown run once for the whole process and all of its threads share the same process_persistent."""
+        if self._end_counters is not None:
+            self._end_counter = self._end_counters[process_num if self._has_own_queues else 0]
+        if self._threads_per_unit == 1:
+            self._run_worker(process_num)
+            return
+
+        shared_kwargs = self._setup_worker() if self._setup_scope == "process" else None
+        first_worker = process_num * self._threads_per_unit
+        threads = [Thread(target=self._run_worker, args=(first_worker + x, shared_kwargs))
+                   for x in range(self._threads_per_unit)]
+        [x.start() for x in threads]
+        [x.join() for x in threads]
+        if shared_kwargs is not None:
+            self._teardown_worker(shared_kwargs)
+
+    def _run_worker(self, worker_num=0, shared_kwargs=None):
+        my_name = self.name + str(worker_num)
 
         dprint("Starting loop for", my_name)
 
-        persistent = None
-        if self._setup is not None:
-            persistent = self._setup()
+        kwargs = self._setup_worker() if shared_kwargs is None else shared_kwargs
+
+        stats = None if self._stats is None else self._stats.recorder(worker_num)
+        outgoing = _OutgoingChunks(self._output, self._chunk_size, stats)
+        profiler = None
+        if self._profiling is not None:
+            profiler = profiling.WorkerProfiler(self._profiling,
+                                                "%s-%d-%d.prof" % (self._profile_prefix, os.getpid(), worker_num))
+
+        if self._is_async:
+            asyncio.run(self._process_chunks_async(my_name, kwargs, outgoing, profiler))
+        else:
+            results_cache = None if self._cache is None else self._cache.open(self._identity())
+            try:
+                self._process_chunks(my_name, kwargs, outgoing, results_cache, profiler)
+            finally:
+                if results_cache is not None:
+                    results_cache.close()
+
+        outgoing.finish()
+        if self._end_counters is not None:
+            _put_end(self._output())
+        if profiler is not None:
+            profiler.finish()
+        if shared_kwargs is None:
+            self._teardown_worker(kwargs)
+        return
+
+    def _next_chunk(self, outgoing, profiler=None):
+        """Waits for the next chunk of input. Returns None at the end of the input."""
+        if self._input() is None:
+            # Broken pipe - abort
+            return None
 
-        is_generator = inspect.isgeneratorfunction(self._callable)
-        outgoing_chunk = []
+        if profiler is not None:
+            profiler.check()
+        outgoing.pause()
+        return self._received(self._get_chunk(), outgoing)
 
+    def _get_chunk(self):
+        """Gets the next chunk of input, reading past every end marker but the last one expected (see _EndCounter)."""
+        input_queue = self._input()
         while True:
-            if self._input() is not None:
-                chunk = self._input().get()
-            else:
-                # Broken pipe - abort
-                break
+            chunk = input_queue.get()
+            if self._end_counter is None or not (isinstance(chunk, str) and chunk == SENTINEL):
+                return chunk
+            if self._end_counter.is_last(input_queue):
+                return chunk
+
+    def _received(self, chunk, outgoing):
+        """Restarts the worker's clock after a chunk arrived. Returns None at the end of the input."""
+        if chunk == SENTINEL or chunk == RETIRE:
+            outgoing.resume()
+            return None
+        outgoing.resume(chunk)
+        return chunk
+
+    def _batch_arguments(self, chunk):
+        """Returns the positional arguments for a batch callable: the chunk as a list or, with batch="numpy", as a
+        NumPy array (one array per column if every item is a tuple of the same length)."""
+        if self._batch != "numpy":
+            return (list(chunk),)
 
-            if chunk == SENTINEL:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("batch='numpy' requires NumPy to be installed.")
+
+        if len(chunk) > 0 and all(isinstance(x, tuple) and len(x) == len(chunk[0]) for x in chunk):
+            return tuple(numpy.asarray(column) for column in zip(*chunk))
+        return (numpy.asarray(chunk),)
+
+    def _call_batch(self, chunk, kwargs):
+        """Calls a batch callable on a whole chunk and returns an iterable over its results."""
+        results = self._callable(*self._batch_arguments(chunk), **kwargs)
+        if results is None:
+            return ()
+        return (x for x in results if x is not None)
+
+    def _process_chunks(self, my_name, kwargs, outgoing, results_cache=None, profiler=None):
+        while True:
+            chunk = self._next_chunk(outgoing, profiler)
+            if chunk is None:
                 break
 
+            if self._batch:
+                try:
+                    for result in self._call_batch(chunk, kwargs):
+                        outgoing.append(result)
+                except:
+                    print("Exception raised in process", my_name, file=sys.stderr)
+                    print(traceback.format_exc(), file=sys.stderr)
+                    raise
+                if len(chunk) > 0 and outgoing.timed:
+                    outgoing.item_done(len(chunk))
+                continue
+
+            timed = outgoing.timed
+            call = self._call if results_cache is None else functools.partial(results_cache.call, self._call)
+            if self._ordered:
+                call = functools.partial(self._call_ordered, call=call)
             for item in chunk:
                 try:
-                    if persistent is None:
-                        if isinstance(item, tuple):
-                            result = self._callable(*item, **self._kwargs)
-                        else:
-                            result = self._callable(item, **self._kwargs)
-                    else:
-                        if isinstance(item, tuple):
-                            result = self._callable(*item, process_persistent=persistent, **self._kwargs)
-                        else:
-                            result = self._callable(item, process_persistent=persistent, **self._kwargs)
+                    for result in call(item, kwargs):
+                        outgoing.append(result)
                 except:
                     print("Exception raised in process", my_name, file=sys.stderr)
                     print(traceback.format_exc(), file=sys.stderr)
                     raise
+                if timed:
+                    outgoing.item_done()
 
-                if is_generator:
-                    for each_result in result:
-                        outgoing_chunk.append(each_result)
-                        if len(outgoing_chunk) >= self._chunk_size:
-                            if self._output() is not None:
-                                self._output().put(outgoing_chunk)
-                            outgoing_chunk = []
-                else:
-                    if result is not None:
-                        # Valueless function, or no result whatsoever.
-                        outgoing_chunk.append(result)
-
-                if len(outgoing_chunk) >= self._chunk_size:
-                    if self._output() is not None:
-                        self._output().put(outgoing_chunk)
-                    outgoing_chunk = []
-
-        if len(outgoing_chunk) > 0:
-            if self._output() is not None:
-                self._output().put(outgoing_chunk)
-
-        if self._teardown is not None:
-            self._teardown(persistent)
+    async def _call_async(self, item, kwargs, outgoing):
+        args = item if isinstance(item, tuple) else (item,)
+        if inspect.isasyncgenfunction(self._callable):
+            async for result in self._callable(*args, **kwargs):
+                outgoing.append(result)
+        else:
+            result = await self._callable(*args, **kwargs)
+            if result is not None:
+                outgoing.append(result)
 
-        return
+    async def _process_chunks_async(self, my_name, kwargs, outgoing, profiler=None):
+        """Runs a coroutine (or async generator) callable with up to `concurrency` items in flight at a time. Results
+        go into the outgoing chunks as they finish, so they may come out in a different order than they came in."""
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self._concurrency)
+        in_flight = set()
+        failures = []
+
+        async def run_one(item):
+            started = time.perf_counter()
+            try:
+                await self._call_async(item, kwargs, outgoing)
+                if outgoing.timed:
+                    outgoing.item_took(time.perf_counter() - started)
+            except BaseException as e:
+                print("Exception raised in process", my_name, file=sys.stderr)
+                print(traceback.format_exc(), file=sys.stderr)
+                failures.append(e)
+            finally:
+                slots.release()
+
+        while len(failures) == 0:
+            input_queue = self._input()
+            if input_queue is None:
+                # Broken pipe - abort
+                break
 
-    def instantiate(self, input, output):
+            # The queues block, so wait for them in the default executor's thread and keep the event loop running.
+            # Only the get() runs there; the worker's clock is only ever touched from the loop's thread.
+            if profiler is not None:
+                profiler.check()
+            outgoing.pause()
+            chunk = self._received(await loop.run_in_executor(None, self._get_chunk), outgoing)
+            if chunk is None:
+                break
+
+            for item in chunk:
+                await slots.acquire()
+                if len(failures) > 0:
+                    break
+                task = loop.create_task(run_one(item))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+
+        if len(in_flight) > 0:
+            await asyncio.wait(in_flight)
+        if len(failures) > 0:
+            raise failures[0]
+
+    def instantiate(self, input, output, with_stats=False, pool=None, pool_workers=(), context=multiprocessing,
+                    profiling=None, profile_prefix=None, ends_expected=None, coordinator=None, sender=None):
+        """Starts the task's workers. With ends_expected, the end of the input is the arrival of that many end markers
+        in each of its input queues, instead of one SENTINEL per worker from close(). Worker processes that don't
+        inherit the MessagingCenter get sender to send messages with."""
+        self._context = context
+        self._sender = sender
+        if ends_expected is not None:
+            if self._has_own_queues:
+                self._end_counters = [_EndCounter(ends_expected, self._threads, context) for x in range(self._num)]
+            else:
+                self._end_counters = [_EndCounter(ends_expected, self._num * self._threads, context)]
+        self._profiling = profiling
+        self._profile_prefix = profile_prefix
         self._input = weakref.ref(input)
         self._output = weakref.ref(output)
+        # The autoscaler reads busy time from the stats, so autoscaling tasks always keep them.
+        if with_stats or self.autoscaling:
+            self._stats = StageStats(self._max_num * self._threads)
+
+        if pool is not None and self._executor == "process":
+            self._processes = [pool.run(worker, self, input, output, x) for x, worker in enumerate(pool_workers)]
+        elif coordinator is not None and self._executor == "process":
+            self._processes = [coordinator.run(self, input, output, x) for x in range(self._num)]
+        elif self._executor == "thread":
+            self._processes = [Thread(target=self._run_in_process)]
+            self._processes[0].start()
+        else:
+            [self._start_process(x) for x in range(self._num)]
+        self._live_workers = len(self._processes)
+
+    def _start_process(self, slot):
+        input = self._input()
+        if self._has_own_queues:
+            input = input.for_worker(slot)
+        process = self._context.Process(target=_worker_main,
+                                        args=(self, input, self._output(), self._stats, slot, self._profiling,
+                                              self._sender))
+        process.start()
+        self._processes.append(process)
+        self._slots[process] = slot
+
+    @property
+    def autoscaling(self):
+        return self._min_num != self._max_num
+
+    @property
+    def live_workers(self):
+        """Number of workers that are running and haven't been asked to retire."""
+        return self._live_workers
+
+    @property
+    def live_processes(self):
+        """Number of processes the task's workers run in. Thread executor workers all share the pipeline's."""
+        if self._executor == "thread":
+            return 1
+        return self._live_workers
+
+    def reap(self):
+        """Forgets about worker processes that already finished (i.e. retired ones), freeing their slots."""
+        for process in [p for p in self._processes if not p.is_alive()]:
+            process.join()
+            self._processes.remove(process)
+            del self._slots[process]
+
+    def add_worker(self):
+        """Starts one more worker process for an autoscaling task. Returns False if there's no room for it."""
+        self.reap()
+        if self._live_workers >= self._max_num or len(self._processes) >= self._max_num:
+            return False
+        taken = set(self._slots.values())
+        self._start_process(min(x for x in range(self._max_num) if x not in taken))
+        self._live_workers += 1
+        if self._closed and self._input() is not None:
+            # The other workers already got their SENTINELs, so this one needs its own.
+            self._input().put(SENTINEL)
+        return True
 
-        num_copies = multiprocessing.cpu_count() if self._num is None else self._num
+    def retire_worker(self):
+        """Asks one worker of an autoscaling task, whichever gets to it first, to finish. Returns False if the task
+        already has as few workers as it may, or is finishing anyway."""
+        if self._live_workers <= self._min_num or self._closed or self._input() is None:
+            return False
+        self._input().put(RETIRE)
+        self._live_workers -= 1
+        return True
 
-        self._processes = [multiprocessing.Process(target=self._run_in_process,
-                                                   args=(x,)) for x in range(num_copies)]
-        [x.start() for x in self._processes]
+    def close(self):
+        """Signals the end of the input by sending a SENTINEL to every live worker thread, in every process. Tasks that
+        count end markers instead get theirs from upstream."""
+        if self._closed or len(self._processes) == 0:
+            return
+
+        self._closed = True
+        if self._input() is not None and self._end_counters is None:
+            [self._input().put(SENTINEL) for x in range(self._live_workers * self._threads_per_unit)]
 
     def join(self):
         if len(self._processes) == 0:
             return
 
-        if self._input() is not None:
-            [self._input().put(SENTINEL) for x in self._processes]
-        [x.join() for x in self._processes]
+        self.close()
+        # An autoscaler may still be adding workers while the task drains its input, so keep going until every
+        # process we know about has finished.
+        joined = set()
+        while True:
+            pending = [p for p in list(self._processes) if p not in joined]
+            if len(pending) == 0:
+                break
+            for p in pending:
+                p.join()
+                joined.add(p)
         return
 
 
+def _worker_main(task, input, output, stats, process_num, profiling, sender=None):
+    """Entry point of every worker process. With the spawn and forkserver start methods, the arguments arrive pickled,
+    so this only gets what the task needs to run."""
+    if sender is not None:
+        messaging.set_worker_sender(sender)
+    task.attach(input, output, stats, profiling=profiling)
+    task._run_in_process(process_num)
+
+
+class _FusedTask(_QTask):
+    """Several consecutive tasks that run, one after the other, in the same worker loop. Items go straight from one
+    callable to the next without a queue in between. The first task decides the number of processes and the input
+    transport; the last one decides the size of the outgoing chunks. Every task keeps its own setup and teardown."""
+
+    def __init__(self, tasks):
+        head, tail = tasks[0], tasks[-1]
+        super().__init__(head._callable, head._num, tail._chunk_size, None, None)
+        self._configure(**dict(head._options, fuse=False, batch=False))
+        self._stages = tasks
+
+    @property
+    def name(self):
+        return "+".join(t.name for t in self._stages)
+
+    def _setup_worker(self):
+        return [t._setup_worker() for t in self._stages]
+
+    def attach(self, input, output, stats=None, pool_state=None, profiling=None):
+        super().attach(input, output, stats, pool_state, profiling)
+        for t in self._stages:
+            t._pool_state = pool_state
+
+    def _teardown_worker(self, kwargs):
+        for t, stage_kwargs in zip(self._stages, kwargs):
+            t._teardown_worker(stage_kwargs)
+
+    def _identity(self):
+        return tuple(t._identity() for t in self._stages)
+
+    def _call(self, item, kwargs, stage=0):
+        results = self._stages[stage]._call(item, kwargs[stage])
+        if stage == len(self._stages) - 1:
+            return results
+        return (each for result in results for each in self._call(result, kwargs, stage + 1))
+
+
 class _Pipeline(object):
     """Manages a multi-stage Extract, Transform, Load process."""
 
-    def __init__(self, max_size=-1):
+    def __init__(self, max_size=-1, transport=None, cpu_budget=None, autoscale_interval=0.5, stats=False, pool=None,
+                 start_method=None, preload=(), ordered=False, reorder_window=None, checkpoint=None,
+                 resume_from=None, max_bytes=None, profile=False, coordinator=None):
         self._max_size = max_size
+        # Queues hold at most max_bytes of pickled chunks, unless the task they feed has a max_bytes of its own.
+        self._max_bytes = max_bytes
+        # Ordered pipelines number the items they're fed, and as_completed puts results back in that order. Feeding
+        # blocks while reorder_window items are still waiting for their results to come out.
+        self._ordered = ordered
+        self._next_sequence = 0
+        self._reorder_window = None if reorder_window is None else BoundedSemaphore(reorder_window)
+        # Checkpointed pipelines number their items too, to record the chunks whose results have all been read. With
+        # resume_from, the chunks a previous run recorded in that file are skipped, and the rest are recorded there.
+        if resume_from is not None:
+            if checkpoint is not None and checkpoint != resume_from:
+                raise ValueError("A pipeline resumed from a checkpoint records its progress in the same file.")
+            checkpoint = resume_from
+        self._checkpoint = None if checkpoint is None else Checkpoint(checkpoint)
+        self._keyed = ordered or self._checkpoint is not None
+        self._next_chunk = 0
+        # Worker processes and queues come from this context; with "forkserver", preload lists the modules that the
+        # fork server imports once, before it starts forking workers.
+        self._context = multiprocessing.get_context(start_method)
+        if len(preload) > 0:
+            if self._context.get_start_method() != "forkserver":
+                raise ValueError("Modules can only be preloaded with start_method='forkserver'.")
+            self._context.set_forkserver_preload(list(preload))
+        self._pool = pool
+        self._pool_channels = None
+        # With a Coordinator, the queues live in its server process and the workers run on its agents.
+        if pool is not None and coordinator is not None:
+            raise ValueError("A pipeline runs either in a WorkerPool or on a Coordinator, not both.")
+        self._coordinator = coordinator
+        self._coordinator_queues = None
+        self._with_stats = stats
+        # Workers run cProfile while this is on; it can be switched at any time (see start_profiling). What they
+        # profiled is merged into one pstats.Stats per stage when the pipeline is joined.
+        self._profiling = self._context.RawValue("b", 1 if profile else 0)
+        self._profile_dir = None
+        self._profiles = {}
+        self._transport = transport
+        self._cpu_budget = multiprocessing.cpu_count() if cpu_budget is None else cpu_budget
+        self._autoscale_interval = autoscale_interval
+        self._autoscaler = None
         self._tasks = []
         self._origins = []
         self._destinations = []
@@ -124,6 +812,21 @@ class _Pipeline(object):
         self._actual_tasks = None
         self._finalize = weakref.finalize(self, self._cleanup)
         self._joined = False
+        # Unless tasks autoscale or run in a pool, the end of the input travels from stage to stage by itself once
+        # the input is closed (see _EndCounter), and the results end after an end marker from each last-stage worker.
+        self._input_closed = False
+        self._cascade = False
+        self._ends_expected = 1
+        self._join_thread = None
+        # Whether anything started reading the results, and whether they were already ended without anything to read
+        # (see _end_results).
+        self._reading_lock = Lock()
+        self._reading = False
+        self._results_ended = False
+        # Reads the results of ordered and checkpointed pipelines that are joined before anything reads them, and what
+        # it read; see _collect_results.
+        self._collector = None
+        self._collected = []
 
     def _new_task(self, callable, num=None, chunk_size=1, setup=None, teardown=None, **kwargs):
         if self._actual_tasks is not None:
@@ -132,6 +835,9 @@ class _Pipeline(object):
         return _QTask(callable, num, chunk_size, setup, teardown, **kwargs)
 
     def add_task(self, callable, num=1, chunk_size=1, setup=None, teardown=None, **kwargs):
+        """Adds a task to the pipeline. Besides the keyword arguments for the callable itself, kwargs may contain
+        any of the task options in _QTask._configure. If the callable declares a parameter with the same name as an
+        option, though, the value goes to the callable, as any other keyword argument would."""
         new_task = self._new_task(callable, num=num, chunk_size=chunk_size, setup=setup, teardown=teardown, **kwargs)
         self._tasks.append(new_task)
 
@@ -149,21 +855,148 @@ class _Pipeline(object):
         if self._actual_tasks is not None:
             raise SequenceError("You are trying to start a pipeline that already started.")
 
-        self._queues.append(multiprocessing.Queue(self._max_size))
-        self._actual_tasks = self._origins + self._tasks + self._destinations
-        for t in self._actual_tasks:
-            self._queues.append(multiprocessing.Queue(self._max_size))
-            t.instantiate(self._queues[-2], self._queues[-1])
+        # Each task's transport, if given, decides what kind of queue feeds it; the pipeline's transport is used for
+        # everything else, including the results queue.
+        self._actual_tasks = self._plan(self._origins + self._tasks + self._destinations)
+        if self._keyed:
+            if any(t._batch or t._is_async for t in self._actual_tasks):
+                raise ValueError("Batch and coroutine tasks can't run in ordered or checkpointed pipelines.")
+            for t in self._actual_tasks:
+                t._ordered = True
+        if self._pool is not None:
+            self._start_in_pool()
+            return
+        if self._coordinator is not None:
+            self._start_on_coordinator()
+            return
+
+        # Named now, since the workers need to know where to write, but only created once profiling is switched on.
+        self._profile_dir = os.path.join(tempfile.gettempdir(), "mpetl-profile-" + uuid.uuid4().hex)
+        if self._profiling.value:
+            os.mkdir(self._profile_dir)
+        profiling.register(self)
+
+        transports = [t._transport or self._transport for t in self._actual_tasks] + [self._transport]
+        max_bytes = [t._max_bytes or self._max_bytes for t in self._actual_tasks] + [self._max_bytes]
+        self._queues = [make_queue(x, self._max_size, self._context, y) for x, y in zip(transports, max_bytes)]
+        for i, t in enumerate(self._actual_tasks):
+            if not t._has_own_queues:
+                continue
+            # Each worker process gets a queue of its own
+            queues = [self._queues[i]] + [make_queue(transports[i], self._max_size, self._context, max_bytes[i])
+                                          for x in range(t._num - 1)]
+            if t._partition_by is not None:
+                self._queues[i] = _PartitionedQueue(queues, t._partition_by, self._keyed)
+            else:
+                self._queues[i] = _StealingQueue(queues)
+        self._cascade = not any(t.autoscaling for t in self._actual_tasks)
+        # Forked workers inherit the MessagingCenter; the others are given what they need to send through it
+        sender = self._messaging_sender() if self._context.get_start_method() != "fork" else None
+        ends_expected = 1
+        for i, t in enumerate(self._actual_tasks):
+            t.instantiate(self._queues[i], self._queues[i + 1], self._with_stats, context=self._context,
+                          profiling=self._profiling, profile_prefix=os.path.join(self._profile_dir, str(i)),
+                          ends_expected=ends_expected if self._cascade else None, sender=sender)
+            ends_expected = t._num * t._threads
+        self._ends_expected = ends_expected
+
+        if any(t.autoscaling for t in self._actual_tasks):
+            self._autoscaler = Autoscaler(self._actual_tasks, self._queues, self._cpu_budget,
+                                          self._autoscale_interval)
+            self._autoscaler.start()
 
         return
 
+    def _messaging_sender(self):
+        """What the workers of this pipeline send messages to named pipelines with, if they don't inherit it. Only
+        Pipeline has messaging."""
+        return None
+
+    def _start_in_pool(self):
+        """Runs the tasks in the pool's workers, connected by the pool's channels."""
+        if self._transport is not None or any(t._transport is not None for t in self._actual_tasks):
+            raise ValueError("Pipelines that run in a WorkerPool use its channels; the pool decides the transport.")
+        if self._max_bytes is not None or any(t._max_bytes is not None for t in self._actual_tasks):
+            raise ValueError("Pipelines that run in a WorkerPool use its channels, which can't be bounded by bytes.")
+        if self._with_stats or self._profiling.value or any(t.autoscaling or t._has_own_queues
+                                                             for t in self._actual_tasks):
+            raise ValueError("Pipelines that run in a WorkerPool can't keep stats, profile workers, autoscale, "
+                             "partition tasks or steal work.")
+
+        workers_needed = [t.pool_workers_needed for t in self._actual_tasks]
+        self._queues, workers = self._pool.acquire(len(self._actual_tasks) + 1, sum(workers_needed))
+        self._pool_channels = self._queues
+        for i, t in enumerate(self._actual_tasks):
+            mine, workers = workers[:workers_needed[i]], workers[workers_needed[i]:]
+            t.instantiate(self._queues[i], self._queues[i + 1], pool=self._pool, pool_workers=mine)
+
+    def _start_on_coordinator(self):
+        """Runs the tasks on the coordinator's agents, connected by queues in the coordinator."""
+        if self._transport is not None or any(t._transport is not None for t in self._actual_tasks):
+            raise ValueError("Pipelines that run on a Coordinator use its queues; it decides the transport.")
+        if self._max_bytes is not None or any(t._max_bytes is not None for t in self._actual_tasks):
+            raise ValueError("Pipelines that run on a Coordinator use its queues, which can't be bounded by bytes.")
+        if self._with_stats or self._profiling.value or any(t.autoscaling or t._has_own_queues
+                                                             for t in self._actual_tasks):
+            raise ValueError("Pipelines that run on a Coordinator can't keep stats, profile workers, autoscale, "
+                             "partition tasks or steal work.")
+
+        self._queues = self._coordinator.create_queues(len(self._actual_tasks) + 1, self._max_size)
+        self._coordinator_queues = self._queues
+        for i, t in enumerate(self._actual_tasks):
+            t.instantiate(self._queues[i], self._queues[i + 1], coordinator=self._coordinator)
+
+    @staticmethod
+    def _plan(tasks):
+        """Turns the list of tasks into the list of stages that will actually run. Every task added with fuse=True is
+        merged into the stage right before it, so there's no queue between them."""
+        groups = []
+        for t in tasks:
+            if t._fuse and len(groups) > 0:
+                if t._is_async or groups[-1][-1]._is_async:
+                    raise ValueError("Coroutine tasks can't be fused with other tasks.")
+                if t._batch or groups[-1][-1]._batch:
+                    raise ValueError("Batch tasks can't be fused with other tasks.")
+                if t.autoscaling or t._has_own_queues or t._cache is not None:
+                    raise ValueError("A task fused into the stage before it runs in that stage's workers, so it "
+                                     "can't have its own min_num, max_num, partition_by, schedule or cache.")
+                groups[-1].append(t)
+            else:
+                groups.append([t])
+        return [g[0] if len(g) == 1 else _FusedTask(g) for g in groups]
+
     def feed_chunk(self, chunk):
         """Takes a chunk of items (i.e. a list of items) and feeds them to the pipeline."""
         if self._actual_tasks is None:
             raise SequenceError("You are feeding a pipeline that hasn't started.")
+        if self._input_closed:
+            raise SequenceError("You are feeding a pipeline whose input was closed.")
 
+        if self._checkpoint is not None:
+            chunk_num = self._next_chunk
+            self._next_chunk += 1
+            if self._checkpoint.done(chunk_num):
+                return
+            chunk = list(chunk)
+            self._checkpoint.fed(chunk_num, self._next_sequence, len(chunk))
+        if self._keyed:
+            chunk = self._number(chunk)
         self._queues[0].put(chunk)
 
+    def _number(self, chunk):
+        """Pairs every item with its sequence number. If the reorder window fills up, puts the items numbered so far
+        and waits for room."""
+        numbered = []
+        for item in chunk:
+            if self._reorder_window is not None and not self._reorder_window.acquire(False):
+                if len(numbered) > 0:
+                    self._queues[0].put(numbered)
+                    numbered = []
+                self._reorder_window.acquire()
+            numbered.append(((self._next_sequence,), item))
+            self._next_sequence += 1
+        return numbered
+
     def feed(self, item):
         """Feeds a single item to the pipeline."""
         self.feed_chunk([item])
@@ -179,6 +1012,52 @@ class _Pipeline(object):
     def queue_lengths(self):
         return [x.qsize() for x in self._queues]
 
+    def stats(self):
+        """Returns, for every stage in pipeline order, its name and the counters of each of its workers (items and
+        chunks in and out, time busy, time blocked on get and put, and a histogram of per-item latencies) as well as
+        their totals. See mpetl.stats for the details."""
+        if self._actual_tasks is None:
+            raise SequenceError("You are asking for the stats of a pipeline that hasn't started.")
+        if not self._with_stats:
+            raise ValueError("Stats are off for this pipeline. Create it with stats=True to collect them.")
+
+        return [dict(stage=t.name, **t._stats.snapshot()) for t in self._actual_tasks]
+
+    def start_profiling(self):
+        """Has every worker run cProfile from its next chunk on."""
+        self._switch_profiling(1)
+
+    def stop_profiling(self):
+        """Has every worker stop profiling from its next chunk on. What was profiled so far is kept."""
+        self._switch_profiling(0)
+
+    def toggle_profiling(self):
+        self._switch_profiling(1 - self._profiling.value)
+
+    def _switch_profiling(self, value):
+        if self._actual_tasks is not None and self._profile_dir is None:
+            raise ValueError("Pipelines that run in a WorkerPool or on a Coordinator can't profile workers.")
+        if value and self._profile_dir is not None:
+            os.makedirs(self._profile_dir, exist_ok=True)
+        self._profiling.value = value
+
+    def _collect_profiles(self):
+        if self._profile_dir is None or not os.path.isdir(self._profile_dir):
+            return
+        for i, t in enumerate(self._actual_tasks):
+            merged = profiling.merge_profiles(os.path.join(self._profile_dir, str(i)) + "-")
+            if merged is not None:
+                self._profiles[t.name] = merged
+        # Nothing is profiled after the workers are done
+        shutil.rmtree(self._profile_dir, ignore_errors=True)
+
+    def profiles(self):
+        """Returns what the workers profiled, as one pstats.Stats per stage name, once the pipeline has been joined.
+        Stages that weren't profiled at all are left out."""
+        if not self._joined:
+            raise SequenceError("Profiles are collected when the pipeline is joined.")
+        return dict(self._profiles)
+
     def join(self):
         """Signals the end of processing, then waits for the associated tasks to end. Once the tasks end,
         puts an end-of processing Sentinel marker in the outgoing queue."""
@@ -189,27 +1068,157 @@ class _Pipeline(object):
             return
 
         self._joined = True
+        self._collect_results()
+        if self._cascade:
+            self.close_input()
 
-        [x.join() for x in self._actual_tasks]
+        for t in self._actual_tasks:
+            if self._autoscaler is not None:
+                self._autoscaler.join(t)
+            else:
+                t.join()
+        if self._autoscaler is not None:
+            self._autoscaler.stop()
+        self._collect_profiles()
+        # The queues between the stages are empty once the workers are done
+        self._release_borrowed_queues(keep_results=True)
+        if not self._cascade:
+            self._end_results()
+        if self._collector is not None:
+            self._collector.join()
+
+    def _collect_results(self):
+        """Starts reading the results in the background if nothing is reading them yet, for ordered and checkpointed
+        pipelines. Their workers put a placeholder for every item without results, which would fill up a bounded
+        results queue, and a checkpoint only records the chunks whose results have been read. A later as_completed()
+        yields what was read."""
+        with self._reading_lock:
+            if not self._keyed or self._reading:
+                return
+            self._reading = True
+            self._collector = Thread(target=lambda: self._collected.extend(self._read_results(join=False)))
+            self._collector.start()
+
+    def _end_results(self):
+        """Puts the SENTINEL that ends the results, for pipelines whose workers don't put end markers of their own. A
+        pool's or a coordinator's results queue that nothing is reading is given back instead, if it's empty, so that
+        pipelines that are only joined don't hold on to it."""
+        with self._reading_lock:
+            if self._borrowed_results() and not self._reading and self.results_queue.empty():
+                self._results_ended = True
+                self._release_borrowed_queues()
+                return
         self.results_queue.put(SENTINEL)
 
+    def close_input(self):
+        """Ends the input: once everything fed so far has gone through the pipeline, its workers finish and the
+        results end. Nothing can be fed after this. Pipelines with autoscaling tasks, or that run in a WorkerPool, can
+        only tell their workers about it from the outside, so for those this joins the pipeline in the background."""
+        if self._actual_tasks is None:
+            raise SequenceError("You are closing the input of a pipeline that hasn't started.")
+        if self._input_closed:
+            return
+
+        self._input_closed = True
+        if self._cascade:
+            _put_end(self._queues[0])
+        elif not self._joined:
+            self._background_join()
+
     def _background_join(self):
         # Joins using a background thread, in order to enable the actual use of as_completed.
-        Thread(target=_Pipeline.join, args=(self,)).start()
+        self._join_thread = Thread(target=_Pipeline.join, args=(self,))
+        self._join_thread.start()
 
-    def as_completed(self):
-        if not self._joined:
+    def as_completed(self, join=True):
+        """Yields the pipeline's results as they come out, in order if the pipeline is ordered. Unless join is False,
+        this ends the input, by joining the pipeline in the background. With join=False, another thread has to do it
+        (for example the one feeding the pipeline, which is what an ordered pipeline with a reorder_window needs)."""
+        with self._reading_lock:
+            self._reading = True
+            collector = self._collector
+            if self._results_ended:
+                return
+        if collector is not None:
+            # The pipeline was joined before this, so it has read the results already, or is reading them
+            collector.join()
+            for result in self._collected:
+                yield result
+            return
+        for result in self._read_results(join):
+            yield result
+
+    def _read_results(self, join):
+        if join and not self._joined:
             self._background_join()
 
+        reorder = _ReorderBuffer(len(self._actual_tasks), self._reorder_window) if self._ordered else None
+        completion = _CompletionTracker() if self._checkpoint is not None else None
+        ends = 0
         while True:
             result_chunk = self.results_queue.get()
             if result_chunk == SENTINEL:
+                ends += 1
+                if self._cascade and ends < self._ends_expected:
+                    continue
+                if join and self._join_thread is not None:
+                    # The results can be in before the workers have finished
+                    self._join_thread.join()
+                self._release_borrowed_queues()
+                if self._checkpoint is not None:
+                    self._checkpoint.close()
                 break
 
-            for result in result_chunk:
-                yield result
+            if not self._keyed:
+                for result in result_chunk:
+                    yield result
+                continue
+
+            if reorder is None:
+                results = result_chunk
+            else:
+                for key, value in result_chunk:
+                    reorder.add(key, value)
+                results = reorder.ready()
+            for key, value in results:
+                if not (isinstance(value, str) and value == NOTHING):
+                    yield value
+                # Only once the result has been dealt with does it count towards its chunk being done
+                if completion is not None:
+                    item = completion.add(key)
+                    if item is not None:
+                        self._checkpoint.item_done(item)
+
+    def results(self):
+        """Yields the pipeline's results as they come out, like as_completed, but leaves the input open: other
+        threads can keep feeding the pipeline while the results are read. Once they're done, close_input() ends the
+        results after everything fed before it, and the pipeline is joined."""
+        for result in self.as_completed(join=False):
+            yield result
+        self.join()
+
+    def _borrowed_results(self):
+        """Whether the results queue is a pool's channel or a coordinator's queue that hasn't been given back yet."""
+        return len(self._pool_channels or self._coordinator_queues or []) > 0
+
+    def _release_borrowed_queues(self, keep_results=False):
+        # Every channel is empty once the results are in (and the ones between the stages, once the workers are done),
+        # so they can be used by the next pipeline. A coordinator's queues are just deleted.
+        if self._pool_channels is not None:
+            released, self._pool_channels = _split_results(self._pool_channels, keep_results)
+            self._pool.release_channels(released)
+        if self._coordinator_queues is not None:
+            released, self._coordinator_queues = _split_results(self._coordinator_queues, keep_results)
+            self._coordinator.release_queues(released)
 
     def _cleanup(self):
+        # The pool's channels belong to the pool, and aren't given back unless they're known to be empty.
+        if self._checkpoint is not None:
+            self._checkpoint.close()
+        if self._profile_dir is not None:
+            shutil.rmtree(self._profile_dir, ignore_errors=True)
+        if self._pool is not None:
+            return
         # Clean up the remaining queues.
         for q in self._queues:
             if q is not None:
@@ -0,0 +1,152 @@
+import multiprocessing
+import pickle
+import sys
+import threading
+import traceback
+import weakref
+from . import messaging
+from .transport import DEFAULT_CAPACITY, SharedMemoryQueue
+from .util import SENTINEL, dprint
+
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+
+class WorkerPool(object):
+    """A set of long-lived worker processes that pipelines can run their tasks in, instead of starting (and setting up)
+    processes of their own every time.
+
+    Queues can't be handed to a process that's already running, so the pool creates every queue its workers will ever
+    use, its channels, before starting them. Channels are SharedMemoryQueues of the given capacity, because a worker
+    that lives on after its task needs its put()s to be done when they return; a multiprocessing.Queue leaves them to
+    a feeder thread that only flushes when the process exits. A pipeline created with pool=... borrows one channel per
+    queue it needs and one worker per process its tasks would have started, and gives the workers back when it's
+    joined and the channels back once its results have been read.
+
+    Each worker runs setup() only the first time it sees a given setup callable, and keeps the process_persistent it
+    returned for every later task with the same setup callable, in any pipeline. The matching teardowns run when the
+    pool is closed."""
+
+    def __init__(self, size=None, channels=None, max_size=-1, capacity=DEFAULT_CAPACITY):
+        self._size = multiprocessing.cpu_count() if size is None or size < 1 else size
+        num_channels = 4 * self._size if channels is None else channels
+        self._channels = [SharedMemoryQueue(max_size, capacity) for x in range(num_channels)]
+        self._commands = [multiprocessing.Queue() for x in range(self._size)]
+        self._idle = [multiprocessing.Event() for x in range(self._size)]
+        self._processes = []
+        for worker in range(self._size):
+            self._idle[worker].set()
+            process = multiprocessing.Process(target=_pool_worker,
+                                              args=(self._commands[worker], self._idle[worker], self._channels))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+        self._free_workers = list(range(self._size))
+        self._free_channels = list(range(num_channels))
+        self._lock = threading.Lock()
+        self._closed = False
+        self._finalize = weakref.finalize(self, WorkerPool._shutdown, self._commands, self._processes,
+                                          self._channels)
+
+    @property
+    def size(self):
+        return self._size
+
+    def acquire(self, num_channels, num_workers):
+        """Reserves num_channels channels and num_workers idle workers for a pipeline. Returns the channels and the
+        workers' numbers."""
+        with self._lock:
+            if self._closed:
+                raise ValueError("This WorkerPool is closed.")
+            if len(self._free_channels) < num_channels or len(self._free_workers) < num_workers:
+                raise ValueError("The pipeline needs %d channels and %d workers, but the pool only has %d and %d free."
+                                 % (num_channels, num_workers, len(self._free_channels), len(self._free_workers)))
+            channels, self._free_channels = self._free_channels[:num_channels], self._free_channels[num_channels:]
+            workers, self._free_workers = self._free_workers[:num_workers], self._free_workers[num_workers:]
+        return [self._channels[x] for x in channels], workers
+
+    def release_channels(self, channels):
+        with self._lock:
+            self._free_channels.extend(self._channels.index(x) for x in channels)
+
+    def _release_worker(self, worker):
+        with self._lock:
+            self._free_workers.append(worker)
+
+    def run(self, worker, task, input, output, worker_num):
+        """Has worker run task's worker loop between the channels input and output. Returns a handle that can be
+        joined like a Process."""
+        self._idle[worker].clear()
+        self._commands[worker].put((pickle.dumps(task, pickle.HIGHEST_PROTOCOL), self._channels.index(input),
+                                    self._channels.index(output), worker_num))
+        return _PoolJob(self, worker)
+
+    def close(self):
+        """Tears down every worker's persistent state and ends the worker processes."""
+        with self._lock:
+            self._closed = True
+        self._finalize()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _shutdown(commands, processes, channels):
+        for c in commands:
+            c.put(SENTINEL)
+        for p in processes:
+            p.join()
+        for c in channels:
+            c.close()
+
+
+class _PoolJob(object):
+    """One task's worker loop running in a pool worker. Quacks like the Process it replaces."""
+
+    def __init__(self, pool, worker):
+        self._pool = pool
+        self._worker = worker
+        self._done = False
+
+    def is_alive(self):
+        return not self._done and not self._pool._idle[self._worker].is_set()
+
+    def join(self):
+        if self._done:
+            return
+        idle, process = self._pool._idle[self._worker], self._pool._processes[self._worker]
+        while not idle.wait(0.1):
+            if not process.is_alive():
+                break
+        self._done = True
+        self._pool._release_worker(self._worker)
+
+
+def _pool_worker(commands, idle, channels):
+    """Main loop of a pool worker: runs the tasks it's sent until it gets a SENTINEL, keeping the process_persistent
+    of every setup callable it has seen along the way."""
+    persistent = {}
+    messaging.relay_only()
+    while True:
+        command = commands.get()
+        if command == SENTINEL:
+            break
+        task, input, output, worker_num = command
+        try:
+            task = pickle.loads(task)
+            task.attach(channels[input], channels[output], pool_state=persistent)
+            dprint("Pool worker running", task.name)
+            task._run_in_process(worker_num)
+            # The worker won't exit, so what it sent has to be delivered before the pool says the task is done
+            messaging.settle()
+        except:
+            print("Exception raised in pool worker", file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+        finally:
+            idle.set()
+
+    for setup, (process_persistent, teardown) in persistent.items():
+        if teardown is not None:
+            teardown(process_persistent)
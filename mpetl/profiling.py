@@ -0,0 +1,75 @@
+import cProfile
+import glob
+import os
+import pstats
+import signal
+import weakref
+
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+# Pipelines in this process, so that a signal can switch profiling on and off in all of them.
+_pipelines = weakref.WeakSet()
+_trap_pid = None
+
+
+class WorkerProfiler(object):
+    """Runs cProfile in one worker thread whenever its pipeline's profiling switch (a shared flag) is on. The switch
+    is only looked at between chunks, so turning it on or off takes effect at the next chunk. Whatever was profiled
+    is written to path when the worker finishes."""
+
+    def __init__(self, switch, path):
+        self._switch = switch
+        self._path = path
+        self._profile = None
+        self._running = False
+
+    def check(self):
+        if self._switch.value == self._running:
+            return
+        if self._running:
+            self._profile.disable()
+        else:
+            if self._profile is None:
+                self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._running = not self._running
+
+    def finish(self):
+        if self._profile is None:
+            return
+        if self._running:
+            self._profile.disable()
+            self._running = False
+        self._profile.dump_stats(self._path)
+
+
+def merge_profiles(prefix):
+    """Merges, and then deletes, the profiles that the workers wrote to files starting with prefix. Returns a
+    pstats.Stats, or None if there were none."""
+    paths = sorted(glob.glob(prefix + "*.prof"))
+    if len(paths) == 0:
+        return None
+    merged = pstats.Stats(*paths)
+    for path in paths:
+        os.unlink(path)
+    return merged
+
+
+def register(pipeline):
+    _pipelines.add(pipeline)
+
+
+def _toggle_profiling(signum, frame):
+    # Workers started with fork inherit the handler, but only the process that set it up owns the pipelines.
+    if os.getpid() != _trap_pid:
+        return
+    for pipeline in list(_pipelines):
+        pipeline.toggle_profiling()
+
+
+def enable_profiling_trap(signum=None):
+    """Makes a signal (SIGUSR2 by default) switch profiling on or off in every pipeline of this process, e.g. with
+    `kill -USR2 <pid>`."""
+    global _trap_pid
+    _trap_pid = os.getpid()
+    signal.signal(signal.SIGUSR2 if signum is None else signum, _toggle_profiling)
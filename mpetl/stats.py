@@ -0,0 +1,101 @@
+import multiprocessing
+import time
+
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+# Counters kept for every worker, in this order.
+FIELDS = ("items_in", "items_out", "chunks_in", "chunks_out", "busy_time", "get_time", "put_time")
+_ITEMS_IN, _ITEMS_OUT, _CHUNKS_IN, _CHUNKS_OUT, _BUSY_TIME, _GET_TIME, _PUT_TIME = range(len(FIELDS))
+
+# Per-item latencies are counted in power-of-two buckets. Bucket 0 holds latencies under a microsecond, bucket k
+# those between 2**(k-1) and 2**k microseconds, and the last bucket everything slower than that.
+LATENCY_BUCKETS = 28
+LATENCY_UPPER_BOUNDS = [2 ** k / 1e6 for k in range(LATENCY_BUCKETS - 1)] + [float("inf")]
+
+
+class StageStats(object):
+    """Throughput and latency counters for every worker of one stage, kept in shared memory.
+
+    Each worker writes only to its own row, so no locking is needed; readers may see a row in the middle of an update,
+    which is fine for monitoring. Workers publish their counters once per chunk, so a snapshot lags behind by up to
+    one chunk per worker."""
+
+    def __init__(self, num_workers):
+        self._num_workers = num_workers
+        self._width = len(FIELDS) + LATENCY_BUCKETS
+        self._values = multiprocessing.RawArray('d', num_workers * self._width)
+        # When each worker started the busy stretch it hasn't published yet (as a time.time() value), or 0 if none.
+        self._busy_since = multiprocessing.RawArray('d', num_workers)
+
+    def recorder(self, worker_num):
+        row = worker_num % self._num_workers
+        return WorkerStats(self._values, row * self._width, self._busy_since, row)
+
+    def unpublished_busy_time(self, now=None):
+        """Returns how long the workers have been busy in the stretches they're still working on, which isn't part of
+        their busy_time yet. Adding both gives an up to date total even while a worker is partway through a long
+        chunk."""
+        now = time.time() if now is None else now
+        return sum(now - since for since in self._busy_since[:] if since > 0)
+
+    def _row(self, worker_num):
+        start = worker_num * self._width
+        row = self._values[start:start + self._width]
+        result = dict(zip(FIELDS, row))
+        for field in ("items_in", "items_out", "chunks_in", "chunks_out"):
+            result[field] = int(result[field])
+        result["latency_histogram"] = [int(x) for x in row[len(FIELDS):]]
+        return result
+
+    def snapshot(self):
+        """Returns the counters of every worker and their totals for the whole stage."""
+        workers = [self._row(x) for x in range(self._num_workers)]
+        totals = {field: sum(w[field] for w in workers) for field in FIELDS}
+        totals["latency_histogram"] = [sum(column) for column in zip(*(w["latency_histogram"] for w in workers))]
+        return {"workers": workers, "totals": totals}
+
+
+class WorkerStats(object):
+    """Keeps one worker's counters in plain local variables and adds them to its row of a StageStats once per chunk,
+    when publish() is called, so that the per-item cost stays low."""
+
+    def __init__(self, values, offset, busy_since, row):
+        self._values = values
+        self._offset = offset
+        self._busy_since = busy_since
+        self._row = row
+        self._local = [0.0] * (len(FIELDS) + LATENCY_BUCKETS)
+
+    def started(self):
+        """Marks the start of a busy stretch, so readers can tell the worker is busy before it publishes."""
+        self._busy_since[self._row] = time.time()
+
+    def publish(self):
+        values, offset, local = self._values, self._offset, self._local
+        for i, amount in enumerate(local):
+            if amount:
+                values[offset + i] += amount
+                local[i] = 0.0
+        self._busy_since[self._row] = 0.0
+
+    def received(self, items, waited):
+        local = self._local
+        local[_ITEMS_IN] += items
+        local[_CHUNKS_IN] += 1
+        local[_GET_TIME] += waited
+
+    def waited(self, seconds):
+        self._local[_GET_TIME] += seconds
+
+    def sent(self, items, waited):
+        local = self._local
+        local[_ITEMS_OUT] += items
+        local[_CHUNKS_OUT] += 1
+        local[_PUT_TIME] += waited
+
+    def busy(self, seconds):
+        self._local[_BUSY_TIME] += seconds
+
+    def item_done(self, latency, count=1):
+        bucket = min(int(latency * 1e6).bit_length(), LATENCY_BUCKETS - 1)
+        self._local[len(FIELDS) + bucket] += count
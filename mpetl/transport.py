@@ -0,0 +1,655 @@
+import io
+import mmap
+import multiprocessing
+import os
+import pickle
+import queue
+import shutil
+import struct
+import tempfile
+import time
+import weakref
+import zlib
+from multiprocessing import shared_memory
+from .util import NOTHING
+
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+# Default size, in bytes, of the ring buffer used by SharedMemoryQueue.
+DEFAULT_CAPACITY = 8 * 1024 * 1024
+
+# Buffers at least this large travel out-of-band, each in a shared memory block of its own, instead of in the pickle.
+OUT_OF_BAND_THRESHOLD = 256 * 1024
+
+# Ring buffer header: read offset, write offset, bytes in use, number of items.
+_HEADER = struct.Struct("qqqq")
+_LENGTH = struct.Struct("q")
+
+# Default size, in bytes, of the segment files a SpillingQueue writes to once its ring buffer is full.
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Spill header: segment and offset being written, size of that segment, segment and offset being read, number of items.
+_SPILL_HEADER = struct.Struct("qqqqqq")
+
+
+class _Exporter(object):
+    """Copies buffers of at least threshold bytes into shared memory blocks of their own, and remembers their names."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.blocks = []
+        self.buffers = []
+
+    def export(self, view):
+        block = shared_memory.SharedMemory(create=True, size=view.nbytes)
+        block.buf[:view.nbytes] = view.cast('B')
+        self.blocks.append(block.name)
+        block.close()
+        return block.name
+
+    def buffer_callback(self, buffer):
+        """Used by pickle for PickleBuffers, which is what NumPy arrays and the like reduce to under protocol 5."""
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            # Not contiguous; let pickle copy it in-band.
+            return True
+        if raw.nbytes < self.threshold:
+            return True
+        self.buffers.append((self.export(raw), raw.nbytes))
+        return False
+
+
+class _OutOfBandPickler(pickle.Pickler):
+    """A protocol 5 Pickler that also moves large bytes, bytearray and memoryview objects out-of-band. pickle only
+    hands PickleBuffers to buffer_callback, and the C pickler never asks reducer_override about bytes and bytearray,
+    but it does call persistent_id for every object, so that's where they're taken out of the pickle."""
+
+    def __init__(self, file, exporter):
+        super().__init__(file, 5, buffer_callback=exporter.buffer_callback)
+        self._exporter = exporter
+
+    def persistent_id(self, obj):
+        kind = type(obj)
+        if kind is bytes or kind is bytearray:
+            if len(obj) >= self._exporter.threshold:
+                return kind.__name__, self._exporter.export(memoryview(obj)), len(obj), None, None
+        elif kind is memoryview:
+            if obj.nbytes >= self._exporter.threshold and obj.c_contiguous:
+                return "memoryview", self._exporter.export(obj), obj.nbytes, obj.format, obj.shape
+            # memoryviews can't be pickled by themselves, so small ones go in the pickle as bytes.
+            return "inline", obj.tobytes(), obj.nbytes, obj.format, obj.shape
+        return None
+
+
+def _attach(name, nbytes, format='B', shape=None):
+    """Maps a block made by _Exporter and removes its name. Returns a memoryview of its contents with the given format
+    and shape; the block is closed, which frees its memory, when that memoryview goes away."""
+    block = shared_memory.SharedMemory(name=name)
+    block.unlink()
+    view = block.buf[:nbytes]
+    if format != 'B' or (shape is not None and len(shape) != 1):
+        view = view.cast(format, shape)
+    weakref.finalize(view, block.close)
+    return view
+
+
+class _OutOfBandUnpickler(pickle.Unpickler):
+    """Rebuilds what _OutOfBandPickler pickled. memoryviews map the shared memory in place; bytes and bytearrays own
+    their memory, so they get exactly one copy."""
+
+    def persistent_load(self, pid):
+        kind, name, nbytes, format, shape = pid
+        if kind == "inline":
+            return memoryview(name).cast(format, shape)
+
+        if kind == "bytes":
+            return bytes(_attach(name, nbytes))
+        if kind == "bytearray":
+            return bytearray(_attach(name, nbytes))
+        return _attach(name, nbytes, format, shape)
+
+
+_SCANNED = {bytes, bytearray, memoryview, list, tuple, dict}
+
+
+def _carries_buffers(obj, threshold):
+    """Whether obj is, or has in its lists, tuples and dicts, a memoryview or a bytes or bytearray of at least
+    threshold bytes. Only those need the (slower) _OutOfBandPickler."""
+    kind = type(obj)
+    if kind is memoryview:
+        return True
+    if kind is bytes or kind is bytearray:
+        return len(obj) >= threshold
+    if kind is dict:
+        obj = obj.values()
+    elif kind is not list and kind is not tuple:
+        return False
+    if _SCANNED.isdisjoint(map(type, obj)):
+        # The usual case, a chunk of plain items, is settled without a Python level loop.
+        return False
+    for x in obj:
+        if type(x) in _SCANNED and _carries_buffers(x, threshold):
+            return True
+    return False
+
+
+def dumps(obj, threshold=OUT_OF_BAND_THRESHOLD):
+    """Pickles obj with protocol 5, moving every buffer of at least threshold bytes into a shared memory block of its
+    own. That covers bytes, bytearray and memoryview objects in lists, tuples and dicts, and anything that pickles to
+    a PickleBuffer, like NumPy arrays. Returns the pickle, with the list of blocks in front of it, and the names of
+    the blocks. The blocks belong to whoever calls loads() (or discard()) on the pickle, exactly once."""
+    exporter = _Exporter(threshold)
+    data = io.BytesIO()
+    if _carries_buffers(obj, threshold):
+        _OutOfBandPickler(data, exporter).dump(obj)
+    else:
+        pickle.Pickler(data, 5, buffer_callback=exporter.buffer_callback).dump(obj)
+    header = pickle.dumps((exporter.buffers, exporter.blocks), pickle.HIGHEST_PROTOCOL)
+    return header + data.getvalue(), exporter.blocks
+
+
+def loads(data):
+    """Rebuilds an object pickled by dumps(). Its shared memory is freed once nothing uses it anymore."""
+    file = io.BytesIO(data)
+    buffers, blocks = pickle.load(file)
+    return _OutOfBandUnpickler(file, buffers=[_attach(name, nbytes) for name, nbytes in buffers]).load()
+
+
+def discard(data):
+    """Frees the shared memory blocks of a pickle made by dumps() that will never be loaded."""
+    buffers, blocks = pickle.load(io.BytesIO(data))
+    for name in blocks:
+        block = shared_memory.SharedMemory(name=name)
+        block.close()
+        block.unlink()
+
+
+class SharedMemoryQueue(object):
+    """A multiprocessing.Queue work-alike that keeps its items in a fixed-size ring buffer in shared memory.
+
+    Items are pickled straight into the buffer by the producer and unpickled straight out of it by the consumer, so
+    there is no feeder thread and no pipe in between. put() blocks while the buffer doesn't have room for the item,
+    or while it already holds maxsize items (if maxsize > 0), just like a bounded multiprocessing.Queue.
+
+    Buffers of at least oob_threshold bytes inside an item don't go through the ring at all: they're moved
+    out-of-band into shared memory blocks of their own (see dumps), and don't count against the capacity. Set
+    oob_threshold to None to keep everything in the ring.
+
+    context is the multiprocessing context whose locks the queue uses; it must match the start method of the
+    processes that share it."""
+
+    def __init__(self, maxsize=-1, capacity=DEFAULT_CAPACITY, oob_threshold=OUT_OF_BAND_THRESHOLD, context=None):
+        self._maxsize = maxsize
+        self._capacity = capacity
+        self._oob_threshold = oob_threshold
+        self._shm = shared_memory.SharedMemory(create=True, size=_HEADER.size + capacity)
+        _HEADER.pack_into(self._shm.buf, 0, 0, 0, 0, 0)
+        self._owner = os.getpid()
+        context = multiprocessing if context is None else context
+        self._lock = context.Lock()
+        self._not_empty = context.Condition(self._lock)
+        self._not_full = context.Condition(self._lock)
+        self._closed = False
+
+    def __getstate__(self):
+        return (self._shm.name, self._maxsize, self._capacity, self._oob_threshold, self._owner, self._lock,
+                self._not_empty, self._not_full)
+
+    def __setstate__(self, state):
+        (name, self._maxsize, self._capacity, self._oob_threshold, self._owner, self._lock, self._not_empty,
+         self._not_full) = state
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._closed = False
+
+    def _write(self, position, data):
+        first = min(len(data), self._capacity - position)
+        start = _HEADER.size + position
+        self._shm.buf[start:start + first] = data[:first]
+        if first < len(data):
+            self._shm.buf[_HEADER.size:_HEADER.size + len(data) - first] = data[first:]
+        return (position + len(data)) % self._capacity
+
+    def _read(self, position, length):
+        first = min(length, self._capacity - position)
+        start = _HEADER.size + position
+        data = bytes(self._shm.buf[start:start + first])
+        if first < length:
+            data += bytes(self._shm.buf[_HEADER.size:_HEADER.size + length - first])
+        return data, (position + length) % self._capacity
+
+    @staticmethod
+    def _wait(condition, predicate, block, timeout):
+        """Waits on condition (whose lock must be held) until predicate() is true. Returns False on timeout."""
+        if predicate():
+            return True
+        if not block:
+            return False
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not predicate():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            condition.wait(remaining)
+        return True
+
+    def _has_room_for(self, needed):
+        _, _, used, count = _HEADER.unpack_from(self._shm.buf, 0)
+        if 0 < self._maxsize <= count:
+            return False
+        return used + needed <= self._capacity
+
+    def _has_items(self):
+        return _HEADER.unpack_from(self._shm.buf, 0)[3] > 0
+
+    def _ring_put(self, data):
+        """Appends a pickle to the ring, which must have room for it. The lock must be held."""
+        read_pos, write_pos, used, count = _HEADER.unpack_from(self._shm.buf, 0)
+        write_pos = self._write(write_pos, _LENGTH.pack(len(data)))
+        write_pos = self._write(write_pos, memoryview(data))
+        _HEADER.pack_into(self._shm.buf, 0, read_pos, write_pos, used + _LENGTH.size + len(data), count + 1)
+
+    def _ring_get(self):
+        """Takes the oldest pickle out of the ring, which must have one. The lock must be held."""
+        read_pos, write_pos, used, count = _HEADER.unpack_from(self._shm.buf, 0)
+        length, read_pos = self._read(read_pos, _LENGTH.size)
+        length = _LENGTH.unpack(length)[0]
+        data, read_pos = self._read(read_pos, length)
+        _HEADER.pack_into(self._shm.buf, 0, read_pos, write_pos, used - _LENGTH.size - length, count - 1)
+        return data
+
+    def _dumps(self, obj):
+        if self._oob_threshold is None:
+            return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        return dumps(obj, self._oob_threshold)[0]
+
+    def _loads(self, data):
+        if self._oob_threshold is None:
+            return pickle.loads(data)
+        return loads(data)
+
+    def put(self, obj, block=True, timeout=None):
+        data = self._dumps(obj)
+        needed = _LENGTH.size + len(data)
+        if needed > self._capacity:
+            self._discard(data)
+            raise ValueError("Object of %d bytes does not fit in a %d byte ring buffer." % (needed, self._capacity))
+
+        with self._lock:
+            if not self._wait(self._not_full, lambda: self._has_room_for(needed), block, timeout):
+                self._discard(data)
+                raise queue.Full
+            self._ring_put(data)
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self._lock:
+            if not self._wait(self._not_empty, self._has_items, block, timeout):
+                raise queue.Empty
+            data = self._ring_get()
+            # Items have different sizes, so any of the waiting producers may now fit.
+            self._not_full.notify_all()
+        return self._loads(data)
+
+    def _discard(self, data):
+        if self._oob_threshold is not None:
+            discard(data)
+
+    def put_nowait(self, obj):
+        self.put(obj, False)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return _HEADER.unpack_from(self._shm.buf, 0)[3]
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return 0 < self._maxsize <= self.qsize()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._shm.close()
+        if os.getpid() == self._owner:
+            self._shm.unlink()
+
+
+class SpillingQueue(SharedMemoryQueue):
+    """A SharedMemoryQueue that writes items to disk instead of blocking when its ring buffer is full, so a fast
+    producer never waits on a slow consumer and memory use stays bounded by the ring's capacity.
+
+    Once an item has been spilled, every item after it is spilled too until the consumers have caught up, so that
+    items still come out in the order they went in. Spilled items are appended to memory-mapped segment files of
+    segment_size bytes (or more, for a larger item) in a temporary directory under spill_dir, and each segment file
+    is deleted as soon as it has been read. Items are always pickled in-band, since buffers moved out-of-band would
+    stay in shared memory. put() only blocks if maxsize > 0 and the queue holds that many items, wherever they are."""
+
+    def __init__(self, maxsize=-1, capacity=DEFAULT_CAPACITY, spill_dir=None, segment_size=DEFAULT_SEGMENT_SIZE,
+                 context=None):
+        super().__init__(maxsize, capacity, oob_threshold=None, context=context)
+        self._segment_size = segment_size
+        self._spill_dir = tempfile.mkdtemp(prefix="mpetl-spill-", dir=spill_dir)
+        self._spill = shared_memory.SharedMemory(create=True, size=_SPILL_HEADER.size)
+        _SPILL_HEADER.pack_into(self._spill.buf, 0, 0, 0, 0, 0, 0, 0)
+        self._segments = {}
+
+    def __getstate__(self):
+        return super().__getstate__() + (self._segment_size, self._spill_dir, self._spill.name)
+
+    def __setstate__(self, state):
+        super().__setstate__(state[:-3])
+        self._segment_size, self._spill_dir, name = state[-3:]
+        self._spill = shared_memory.SharedMemory(name=name)
+        self._segments = {}
+
+    def _segment(self, number, size=None):
+        """Maps a segment file into this process, creating it with the given size if there's one."""
+        if number not in self._segments:
+            path = os.path.join(self._spill_dir, "segment-%08d" % number)
+            with open(path, "w+b" if size is not None else "r+b") as f:
+                if size is not None:
+                    f.truncate(size)
+                self._segments[number] = mmap.mmap(f.fileno(), 0)
+        return self._segments[number]
+
+    def _forget_segments(self, below):
+        """Unmaps the segments that have been read to the end, in this process."""
+        for number in [x for x in self._segments if x < below]:
+            self._segments.pop(number).close()
+
+    def _spilled(self):
+        return _SPILL_HEADER.unpack_from(self._spill.buf, 0)[5]
+
+    def _spill_put(self, data):
+        write_seg, write_pos, write_size, read_seg, read_pos, count = _SPILL_HEADER.unpack_from(self._spill.buf, 0)
+        needed = _LENGTH.size + len(data)
+        if write_pos + needed > write_size:
+            if write_size > 0:
+                # A zero length tells the reader to go on to the next segment, unless it can tell from the size
+                if write_size - write_pos >= _LENGTH.size:
+                    _LENGTH.pack_into(self._segment(write_seg), write_pos, 0)
+                write_seg += 1
+            write_pos, write_size = 0, max(self._segment_size, needed)
+            self._segment(write_seg, write_size)
+        segment = self._segment(write_seg)
+        _LENGTH.pack_into(segment, write_pos, len(data))
+        segment[write_pos + _LENGTH.size:write_pos + needed] = data
+        _SPILL_HEADER.pack_into(self._spill.buf, 0, write_seg, write_pos + needed, write_size, read_seg, read_pos,
+                                count + 1)
+        self._forget_segments(read_seg)
+
+    def _spill_get(self):
+        write_seg, write_pos, write_size, read_seg, read_pos, count = _SPILL_HEADER.unpack_from(self._spill.buf, 0)
+        segment = self._segment(read_seg)
+        while read_pos + _LENGTH.size > len(segment) or _LENGTH.unpack_from(segment, read_pos)[0] == 0:
+            # That segment has been read to the end, and won't be needed again by anyone.
+            os.unlink(os.path.join(self._spill_dir, "segment-%08d" % read_seg))
+            read_seg, read_pos = read_seg + 1, 0
+            self._forget_segments(read_seg)
+            segment = self._segment(read_seg)
+        length = _LENGTH.unpack_from(segment, read_pos)[0]
+        data = segment[read_pos + _LENGTH.size:read_pos + _LENGTH.size + length]
+        _SPILL_HEADER.pack_into(self._spill.buf, 0, write_seg, write_pos, write_size, read_seg,
+                                read_pos + _LENGTH.size + length, count - 1)
+        return data
+
+    def _has_items(self):
+        return super()._has_items() or self._spilled() > 0
+
+    def _has_room(self):
+        return not 0 < self._maxsize <= self.qsize()
+
+    def put(self, obj, block=True, timeout=None):
+        data = self._dumps(obj)
+        with self._lock:
+            if not self._wait(self._not_full, self._has_room, block, timeout):
+                raise queue.Full
+            if self._spilled() == 0 and self._has_room_for(_LENGTH.size + len(data)):
+                self._ring_put(data)
+            else:
+                self._spill_put(data)
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self._lock:
+            if not self._wait(self._not_empty, self._has_items, block, timeout):
+                raise queue.Empty
+            # Whatever is in the ring went in before anything that's on disk.
+            data = self._ring_get() if super()._has_items() else self._spill_get()
+            self._not_full.notify_all()
+        return self._loads(data)
+
+    def qsize(self):
+        return super().qsize() + self._spilled()
+
+    def close(self):
+        if self._closed:
+            return
+        self._forget_segments(float("inf"))
+        self._spill.close()
+        if os.getpid() == self._owner:
+            self._spill.unlink()
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+        super().close()
+
+
+class _ByteBoundedQueue(object):
+    """Wraps a queue so that it holds at most max_bytes of pickled chunks. Chunks are pickled by the producer, which
+    blocks in put() while they wouldn't fit; a chunk larger than max_bytes on its own goes through once the queue is
+    empty. The number of bytes in the queue is shared by every process that uses it."""
+
+    def __init__(self, queue, max_bytes, context=None):
+        context = multiprocessing if context is None else context
+        self._queue = queue
+        self._max_bytes = max_bytes
+        self._in_flight = context.Value("q", 0, lock=False)
+        self._changed = context.Condition()
+
+    def _fits(self, size):
+        return self._in_flight.value == 0 or self._in_flight.value + size <= self._max_bytes
+
+    def put(self, obj, block=True, timeout=None):
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        with self._changed:
+            if not SharedMemoryQueue._wait(self._changed, lambda: self._fits(len(data)), block, timeout):
+                raise queue.Full
+            self._in_flight.value += len(data)
+        try:
+            self._queue.put(data, block, timeout)
+        except BaseException:
+            self._release(len(data))
+            raise
+
+    def _release(self, size):
+        with self._changed:
+            self._in_flight.value -= size
+            self._changed.notify_all()
+
+    def get(self, block=True, timeout=None):
+        data = self._queue.get(block, timeout)
+        self._release(len(data))
+        return pickle.loads(data)
+
+    def put_nowait(self, obj):
+        self.put(obj, False)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    @property
+    def bytes_in_flight(self):
+        return self._in_flight.value
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def empty(self):
+        return self._queue.empty()
+
+    def close(self):
+        self._queue.close()
+
+
+class _PerWorkerQueues(object):
+    """Feeds a task whose worker processes each have an input queue of their own. Markers (strings such as the end of
+    input SENTINEL) go to the queues in turn, so putting one per worker reaches every worker; how chunks are spread is
+    up to the subclass."""
+
+    def __init__(self, queues):
+        self.queues = queues
+        self._next = 0
+
+    def _put_next(self, obj, block, timeout):
+        self.queues[self._next % len(self.queues)].put(obj, block, timeout)
+        self._next += 1
+
+    def put(self, chunk, block=True, timeout=None):
+        self._put_next(chunk, block, timeout)
+
+    def get(self, block=True, timeout=None):
+        raise TypeError("Workers get their input from for_worker(), not from the queues as a whole.")
+
+    def for_worker(self, slot):
+        """Returns the queue the worker in the given slot reads from."""
+        return self.queues[slot]
+
+    def qsize(self):
+        return sum(x.qsize() for x in self.queues)
+
+    def empty(self):
+        return all(x.empty() for x in self.queues)
+
+    def close(self):
+        for x in self.queues:
+            x.close()
+
+
+class _PartitionedQueue(_PerWorkerQueues):
+    """Routes every item to the worker picked by a stable hash of key(item), so items with the same key always reach
+    the same worker.
+
+    In ordered pipelines, items travel as (sequence key, item) pairs; with ordered=True the key is computed from the
+    item alone, and the placeholders of items without results go wherever their sequence key hashes to."""
+
+    def __init__(self, queues, key, ordered=False):
+        super().__init__(queues)
+        self._key = key
+        self._ordered = ordered
+
+    def _partition_of(self, item):
+        if not self._ordered:
+            key = self._key(item)
+        elif isinstance(item[1], str) and item[1] == NOTHING:
+            # Placeholder for an item without results; any worker can pass it on.
+            key = item[0]
+        else:
+            key = self._key(item[1])
+        # hash() of strings differs from process to process, so it can't be used here.
+        return zlib.crc32(pickle.dumps(key, 4)) % len(self.queues)
+
+    def put(self, chunk, block=True, timeout=None):
+        if isinstance(chunk, str):
+            self._put_next(chunk, block, timeout)
+            return
+
+        split = [[] for x in self.queues]
+        for item in chunk:
+            split[self._partition_of(item)].append(item)
+        for q, items in zip(self.queues, split):
+            if len(items) > 0:
+                q.put(items, block, timeout)
+
+
+class _StealingQueue(_PerWorkerQueues):
+    """Spreads chunks over the workers' queues round-robin. A worker whose own queue is empty takes chunks from the
+    others' (see _StealingWorker), so no single queue's lock is shared by every worker of the task."""
+
+    def for_worker(self, slot):
+        return _StealingWorker(self.queues, slot)
+
+
+class _StealingWorker(object):
+    """One worker's end of a _StealingQueue: gets from its own queue first, then steals from the other workers',
+    starting with the one after it so that thieves spread out. Markers are never stolen; one taken by mistake goes
+    back at the end of the queue it came from. That only ever moves a marker behind chunks, never ahead of them, and an
+    upstream stage with several workers may still be filling the queue after the first of its markers arrived, so the
+    queue is tried again next time."""
+
+    def __init__(self, queues, slot, poll_interval=0.01):
+        self._own = queues[slot]
+        self._others = queues[slot + 1:] + queues[:slot]
+        self._poll_interval = poll_interval
+
+    def _steal(self):
+        for victim in self._others:
+            try:
+                chunk = victim.get(False)
+            except queue.Empty:
+                continue
+            if not isinstance(chunk, str):
+                return chunk
+            victim.put(chunk)
+        return None
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return self._own.get(False)
+            except queue.Empty:
+                pass
+            chunk = self._steal()
+            if chunk is not None:
+                return chunk
+            wait = self._poll_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+            if not block or wait <= 0:
+                raise queue.Empty
+            try:
+                return self._own.get(True, wait)
+            except queue.Empty:
+                pass
+
+    def put(self, obj, block=True, timeout=None):
+        self._own.put(obj, block, timeout)
+
+    def qsize(self):
+        return self._own.qsize()
+
+
+# Transports that can be selected by name when creating a Pipeline or adding a task to it.
+TRANSPORTS = {
+    "queue": multiprocessing.Queue,
+    "shm": SharedMemoryQueue,
+    "spill": SpillingQueue,
+}
+
+
+def make_queue(transport=None, max_size=-1, context=None, max_bytes=None):
+    """Creates a queue for the given transport, which may be the name of a known transport, a callable that takes
+    max_size and returns an object with put/get/close methods, or None for the default multiprocessing.Queue. Named
+    transports use the given multiprocessing context, if any. With max_bytes, the queue also holds at most that many
+    bytes of pickled chunks (see _ByteBoundedQueue)."""
+    if max_bytes is not None:
+        return _ByteBoundedQueue(make_queue(transport, max_size, context), max_bytes, context)
+    if transport is None:
+        transport = "queue"
+    if context is not None:
+        if transport == "queue":
+            return context.Queue(max_size)
+        if transport == "shm":
+            return SharedMemoryQueue(max_size, context=context)
+        if transport == "spill":
+            return SpillingQueue(max_size, context=context)
+    if callable(transport):
+        return transport(max_size)
+    try:
+        return TRANSPORTS[transport](max_size)
+    except KeyError:
+        raise ValueError("Unknown transport %r. Known transports are: %s" % (transport, ", ".join(TRANSPORTS)))
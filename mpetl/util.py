@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import os
 import random
 import signal
 from multiprocessing import Event
@@ -9,7 +10,26 @@ __author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
 def _random_string(length=50):
     return ''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for i in range(50))
 
-SENTINEL = "##" + _random_string(50) + "##"
+
+def _marker(name):
+    """Returns a random marker that's the same in every process of the program. Workers started with the spawn and
+    forkserver start methods import this module anew, so the marker is kept in the environment they inherit."""
+    variable = "MPETL_" + name
+    if variable not in os.environ:
+        os.environ[variable] = "##" + _random_string(50) + "##"
+    return os.environ[variable]
+
+def marker_environment():
+    """Returns the environment variables that hold the markers, for processes that can't inherit them (e.g. agents on
+    other machines)."""
+    return {x: os.environ[x] for x in ("MPETL_SENTINEL", "MPETL_RETIRE", "MPETL_NOTHING")}
+
+
+SENTINEL = _marker("SENTINEL")
+# Tells exactly one worker of an autoscaling task to finish, without ending the task.
+RETIRE = _marker("RETIRE")
+# Stands for "no results" in ordered pipelines, where every item has to leave something behind.
+NOTHING = _marker("NOTHING")
 
 _verbose_debugging = Event()
 #  Shortcut
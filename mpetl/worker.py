@@ -0,0 +1,90 @@
+"""Runs pipeline workers for a Coordinator, possibly on another machine.
+
+Start one agent per machine with `python -m mpetl.worker host:port`, giving it the coordinator's authkey with
+--authkey or in the MPETL_AUTHKEY environment variable. It runs up to --slots workers at a time, each in a process of
+its own, and finishes when the coordinator is closed."""
+import argparse
+import multiprocessing
+import os
+import pickle
+import sys
+import traceback
+from threading import Thread
+from .cluster import connect, _RemoteQueue
+from .util import dprint
+
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+
+def _run_job(address, authkey, job):
+    """Runs in a process of its own: one task's worker loop, between two of the coordinator's queues."""
+    control = connect(address, authkey).control()
+    task, input, output, worker_num = pickle.loads(job)
+    input, output = _RemoteQueue(control, input), _RemoteQueue(control, output)
+    task.attach(input, output)
+    dprint("Agent running", task.name)
+    try:
+        task._run_in_process(worker_num)
+    except:
+        print("Exception raised in agent worker", task.name, file=sys.stderr)
+        print(traceback.format_exc(), file=sys.stderr)
+        raise
+
+
+def _serve_slot(control, address, authkey, end):
+    """Takes jobs from the coordinator, one at a time, until it says to stop (with end, its SENTINEL) or goes away."""
+    # Workers are spawned, so that they import mpetl with the coordinator's markers in their environment
+    context = multiprocessing.get_context("spawn")
+    while True:
+        try:
+            job = control.next_job()
+        except (EOFError, OSError):
+            return
+        if isinstance(job, str) and job == end:
+            return
+        job_id, job = job
+        process = context.Process(target=_run_job, args=(address, authkey, job))
+        process.start()
+        process.join()
+        try:
+            control.finished(job_id, process.exitcode)
+        except (EOFError, OSError):
+            return
+
+
+def run_agent(address, authkey, slots=None):
+    """Connects to the coordinator at address and runs its jobs, up to slots (by default, one per CPU) at a time."""
+    slots = multiprocessing.cpu_count() if slots is None else slots
+    control = connect(address, authkey).control()
+    # The markers of this process were made up when mpetl was imported, and only match the coordinator's if it was
+    # inherited from there; its workers get the coordinator's.
+    markers = control.hello(slots)
+    os.environ.update(markers)
+    threads = [Thread(target=_serve_slot, args=(control, address, authkey, markers["MPETL_SENTINEL"]))
+               for x in range(slots)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+
+def _address(text):
+    host, _, port = text.rpartition(":")
+    if host == "" or not port.isdigit():
+        raise argparse.ArgumentTypeError("expected host:port, not %r" % text)
+    return host, int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m mpetl.worker", description=__doc__.splitlines()[0])
+    parser.add_argument("address", type=_address, help="the coordinator's address, as host:port")
+    parser.add_argument("--authkey", default=os.environ.get("MPETL_AUTHKEY"),
+                        help="the coordinator's authkey (default: the MPETL_AUTHKEY environment variable)")
+    parser.add_argument("--slots", type=int, default=None,
+                        help="workers to run at the same time (default: one per CPU)")
+    args = parser.parse_args(argv)
+    if args.authkey is None:
+        parser.error("the coordinator's authkey is needed, with --authkey or MPETL_AUTHKEY")
+    run_agent(args.address, args.authkey.encode(), args.slots)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
 __author__ = 'Jorge Herskovic <jherskovic@gmail.com>'
 
+import random
+import threading
+import time
 import unittest
-from mpetl.pipeline import SequenceError, _Pipeline
+import multiprocessing
+import os
+from mpetl.pipeline import SequenceError, _Pipeline, _FusedTask
 
 # The following functions use different operations so a change in order will ruin them
 
@@ -20,6 +25,42 @@ def iterator_origin(up_to):
 
     return
 
+def fan_out(parameter):
+    yield parameter
+    yield parameter + 1000
+
+def setup_offset():
+    return {'offset': 10000}
+
+num_teardowns = multiprocessing.Value('i', 0)
+
+def teardown_offset(persistent):
+    assert persistent['offset'] == 10000
+    with num_teardowns.get_lock():
+        num_teardowns.value += 1
+
+def add_offset(parameter, process_persistent):
+    return parameter + process_persistent['offset']
+
+def jittery_fan_out(parameter):
+    time.sleep(random.random() / 500)
+    for i in range(parameter % 3):
+        yield parameter * 10 + i
+
+def slow_stage(parameter):
+    time.sleep(0.01)
+    return parameter
+
+def long_stage(parameter):
+    time.sleep(1)
+    return parameter
+
+def with_worker_pid(parameter):
+    return parameter, os.getpid()
+
+def key_of_pair(parameter):
+    return parameter[0]
+
 class Test_Pipeline(unittest.TestCase):
     def test_basic_pipeline(self):
         self.pipe = _Pipeline()
@@ -101,6 +142,221 @@ class Test_Pipeline(unittest.TestCase):
     def test_very_parallel_pipeline_even_longer(self):
         self.test_very_parallel_pipeline(num_items=4000)
 
+    def test_fused_pipeline(self):
+        self.pipe = _Pipeline()
+        self.pipe.add_origin(iterator_origin, num=1, chunk_size=11)
+        self.pipe.add_task(first_stage, num=3, fuse=True)
+        self.pipe.add_task(fan_out, num=2, chunk_size=5)
+        self.pipe.add_task(add_offset, fuse=True, setup=setup_offset, teardown=teardown_offset)
+        self.pipe.start()
+        # The origin and the first stage run together, and so do fan_out and add_offset.
+        self.assertEqual(len(self.pipe._actual_tasks), 2)
+        self.assertIsInstance(self.pipe._actual_tasks[0], _FusedTask)
+        self.assertEqual(self.pipe._actual_tasks[1].name, "fan_out+add_offset")
+        self.pipe.feed(100)
+        self.pipe.join()
+        result = sorted(x for x in self.pipe.as_completed())
+        expected = sorted(y + 10000 for x in range(100) for y in (x + 1, x + 1001))
+        self.assertEqual(result, expected)
+        # fan_out's two processes each ran add_offset's setup and teardown
+        self.assertEqual(num_teardowns.value, 2)
+
+    def test_stats(self):
+        self.pipe = _Pipeline(stats=True)
+        self.assertRaises(SequenceError, self.pipe.stats)
+        self.pipe.add_origin(iterator_origin, num=1, chunk_size=10)
+        self.pipe.add_task(first_stage, num=2, chunk_size=5)
+        self.pipe.start()
+        self.pipe.feed(100)
+        self.pipe.join()
+        origin, task = self.pipe.stats()
+        self.assertEqual(origin['stage'], 'iterator_origin')
+        self.assertEqual(origin['totals']['items_in'], 1)
+        self.assertEqual(origin['totals']['items_out'], 100)
+        self.assertEqual(origin['totals']['chunks_out'], 10)
+        self.assertEqual(sum(origin['totals']['latency_histogram']), 1)
+        self.assertEqual(len(task['workers']), 2)
+        self.assertEqual(task['totals']['items_in'], 100)
+        self.assertEqual(task['totals']['items_out'], 100)
+        self.assertEqual(sum(task['totals']['latency_histogram']), 100)
+        self.assertGreater(task['totals']['get_time'], 0)
+
+    def test_stats_are_opt_in(self):
+        self.pipe = _Pipeline()
+        self.pipe.add_task(first_stage, num=1)
+        self.pipe.start()
+        self.pipe.join()
+        self.assertRaises(ValueError, self.pipe.stats)
+
+    def test_autoscaling_up(self):
+        self.pipe = _Pipeline(cpu_budget=6, autoscale_interval=0.05, stats=True)
+        self.pipe.add_origin(iterator_origin, num=1)
+        self.pipe.add_task(slow_stage, num=1, max_num=4)
+        self.pipe.start()
+        self.pipe.feed(200)
+        self.pipe.join()
+        self.assertEqual(sorted(self.pipe.as_completed()), list(range(200)))
+        workers = self.pipe.stats()[1]['workers']
+        self.assertGreater(len([w for w in workers if w['items_in'] > 0]), 1)
+
+    def test_autoscaling_down(self):
+        self.pipe = _Pipeline(autoscale_interval=0.05)
+        self.pipe.add_task(first_stage, num=3, min_num=1, max_num=3)
+        self.pipe.start()
+        task = self.pipe._actual_tasks[0]
+        for i in range(100):
+            if task.live_workers == 1:
+                break
+            time.sleep(0.05)
+        self.assertEqual(task.live_workers, 1)
+        self.pipe.feed_chunk(list(range(10)))
+        self.pipe.join()
+        self.assertEqual(sorted(self.pipe.as_completed()), [x + 1 for x in range(10)])
+
+    def test_autoscaling_keeps_workers_busy_with_a_long_chunk(self):
+        self.pipe = _Pipeline(autoscale_interval=0.05)
+        self.pipe.add_task(long_stage, num=2, min_num=1, max_num=2, chunk_size=1)
+        self.pipe.start()
+        self.pipe.feed_chunk([1])
+        self.pipe.feed_chunk([2])
+        task = self.pipe._actual_tasks[0]
+        time.sleep(0.5)
+        # Neither worker has finished its chunk, but both are busy and must not be retired
+        self.assertEqual(task.live_workers, 2)
+        self.assertGreater(task._stats.unpublished_busy_time(), 0)
+        self.pipe.join()
+        self.assertEqual(sorted(self.pipe.as_completed()), [1, 2])
+
+    def test_spawn(self):
+        self.pipe = _Pipeline(start_method="spawn", stats=True)
+        self.pipe.add_task(add_offset, num=2, setup=setup_offset, teardown=teardown_offset)
+        self.pipe.add_task(second_stage)
+        self.pipe.start()
+        for i in range(20):
+            self.pipe.feed(i)
+        self.pipe.join()
+        self.assertEqual(sorted(self.pipe.as_completed()), sorted(x + 10000 - 3 for x in range(20)))
+        self.assertEqual(self.pipe.stats()[0]['totals']['items_in'], 20)
+
+    def test_forkserver_preload(self):
+        self.assertRaises(ValueError, _Pipeline, preload=["json"])
+        self.pipe = _Pipeline(start_method="forkserver", preload=["json"])
+        self.pipe.add_task(first_stage, num=2)
+        self.pipe.start()
+        self.pipe.feed_chunk(list(range(10)))
+        self.pipe.join()
+        self.assertEqual(sorted(self.pipe.as_completed()), [x + 1 for x in range(10)])
+
+    def test_ordered(self):
+        self.pipe = _Pipeline(ordered=True)
+        self.pipe.add_task(first_stage, num=3)
+        # Fans each item out to zero, one or two results, taking a random time to do so
+        self.pipe.add_task(jittery_fan_out, num=4, chunk_size=3)
+        self.pipe.add_task(third_stage, num=2)
+        self.pipe.start()
+        for i in range(50):
+            self.pipe.feed_chunk([i * 4 + x for x in range(4)])
+        self.pipe.join()
+        expected = [(y * 10 + i) * 5 for y in range(1, 201) for i in range(y % 3)]
+        self.assertEqual(list(self.pipe.as_completed()), expected)
+
+    def test_reorder_window(self):
+        self.pipe = _Pipeline(ordered=True, reorder_window=5)
+        self.pipe.add_task(slow_stage, num=3)
+        self.pipe.start()
+        # Feeding blocks while five items are waiting, so it has to happen while the results are read
+        feeder = threading.Thread(target=lambda: [self.pipe.feed(x) for x in range(40)] + [self.pipe.join()])
+        feeder.start()
+        results = []
+        for result in self.pipe.as_completed(join=False):
+            results.append(result)
+            self.assertLessEqual(self.pipe._next_sequence, len(results) + 5)
+        feeder.join()
+        self.assertEqual(results, list(range(40)))
+
+    def test_fused_task_cannot_autoscale(self):
+        self.pipe = _Pipeline()
+        self.pipe.add_task(first_stage)
+        self.pipe.add_task(second_stage, fuse=True, min_num=1, max_num=4)
+        self.assertRaises(ValueError, self.pipe.start)
+
+    def test_partition_by(self):
+        self.pipe = _Pipeline()
+        self.pipe.add_task(first_stage, num=2)
+        self.pipe.add_task(with_worker_pid, num=3, chunk_size=4, partition_by=lambda x: x % 5)
+        self.pipe.start()
+        for i in range(20):
+            self.pipe.feed_chunk([i * 10 + x for x in range(10)])
+        self.pipe.join()
+        workers = {}
+        results = list(self.pipe.as_completed())
+        for item, pid in results:
+            workers.setdefault(item % 5, set()).add(pid)
+        self.assertEqual(sorted(x for x, pid in results), [x + 1 for x in range(200)])
+        self.assertTrue(all(len(x) == 1 for x in workers.values()))
+
+    def test_ordered_partition_by(self):
+        self.pipe = _Pipeline(ordered=True)
+        self.pipe.add_task(jittery_fan_out, num=2)
+        self.pipe.add_task(third_stage, num=3, partition_by=lambda x: x % 7)
+        self.pipe.start()
+        self.pipe.feed_chunk(list(range(60)))
+        self.pipe.join()
+        expected = [(y * 10 + i) * 5 for y in range(60) for i in range(y % 3)]
+        self.assertEqual(list(self.pipe.as_completed()), expected)
+
+    def test_partition_by_needs_fixed_processes(self):
+        self.pipe = _Pipeline()
+        self.assertRaises(ValueError, self.pipe.add_task, first_stage, min_num=1, max_num=3, partition_by=str)
+        self.assertRaises(ValueError, self.pipe.add_task, first_stage, threads=2, partition_by=str)
+        self.pipe.add_task(first_stage)
+        self.pipe.add_task(second_stage, fuse=True, partition_by=str)
+        self.assertRaises(ValueError, self.pipe.start)
+
+    def test_streaming_results(self):
+        self.pipe = _Pipeline()
+        self.pipe.add_task(first_stage, num=2)
+        self.pipe.add_task(third_stage, num=3)
+        self.pipe.start()
+        results = self.pipe.results()
+        # Each result comes out while the input is still open
+        for i in range(5):
+            self.pipe.feed(i)
+            self.assertEqual(next(results), (i + 1) * 5)
+        self.pipe.close_input()
+        self.assertEqual(list(results), [])
+        self.assertTrue(all(not p.is_alive() for t in self.pipe._actual_tasks for p in t._processes))
+        self.assertRaises(SequenceError, self.pipe.feed, 5)
+
+    def test_close_input_while_feeding(self):
+        self.pipe = _Pipeline()
+        self.pipe.add_task(fan_out, num=3, chunk_size=7)
+        self.pipe.add_task(first_stage, num=2, threads=2)
+        self.pipe.add_task(second_stage, num=2, schedule="steal")
+        self.pipe.add_task(third_stage, num=3, partition_by=lambda x: x % 2)
+        self.pipe.start()
+
+        def feed_everything():
+            for i in range(100):
+                self.pipe.feed_chunk([i * 10 + x for x in range(10)])
+            self.pipe.close_input()
+
+        feeder = threading.Thread(target=feed_everything)
+        feeder.start()
+        results = sorted(self.pipe.results())
+        feeder.join()
+        expected = sorted((y - 2) * 5 for x in range(1000) for y in (x, x + 1000))
+        self.assertEqual(results, expected)
+
+    def test_close_input_autoscaling(self):
+        self.pipe = _Pipeline()
+        self.pipe.add_task(first_stage, min_num=1, max_num=2)
+        self.pipe.start()
+        for i in range(10):
+            self.pipe.feed(i)
+        self.pipe.close_input()
+        self.assertEqual(sorted(self.pipe.results()), [x + 1 for x in range(10)])
+
     # def test_very_parallel_pipeline_limited_depth(self):
     #     self.test_very_parallel_pipeline(num_items=1000, pipeline_depth=500)
 
@@ -0,0 +1,107 @@
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+import asyncio
+import time
+import unittest
+from mpetl import AsyncPipeline
+from mpetl.pipeline import _Pipeline, SequenceError
+
+
+def add_one(parameter):
+    return parameter + 1
+
+
+def slow_add_one(parameter):
+    time.sleep(0.01)
+    return parameter + 1
+
+
+class test_aio(unittest.TestCase):
+    def test_feed_and_read_concurrently(self):
+        async def main():
+            pipe = AsyncPipeline(_Pipeline())
+            pipe.add_task(add_one, num=2)
+            pipe.add_task(add_one, num=3)
+            pipe.start()
+
+            async def producer(first):
+                for i in range(first, first + 50, 10):
+                    await pipe.feed_chunk(list(range(i, i + 10)))
+
+            async def feed_everything():
+                await asyncio.gather(*(producer(x) for x in range(0, 200, 50)))
+                await pipe.close_input()
+
+            feeding = asyncio.ensure_future(feed_everything())
+            results = [x async for x in pipe.results()]
+            await feeding
+            return results
+
+        self.assertEqual(sorted(asyncio.run(main())), [x + 2 for x in range(200)])
+
+    def test_backpressure_keeps_the_loop_running(self):
+        async def main():
+            pipe = AsyncPipeline(_Pipeline(max_size=1), max_pending=1)
+            pipe.add_task(slow_add_one, num=1)
+            pipe.start()
+            ticks = 0
+            done = asyncio.Event()
+
+            async def ticker():
+                nonlocal ticks
+                while not done.is_set():
+                    ticks += 1
+                    await asyncio.sleep(0.001)
+
+            async def feed_everything():
+                for i in range(30):
+                    await pipe.feed(i)
+                await pipe.close_input()
+
+            ticking = asyncio.ensure_future(ticker())
+            feeding = asyncio.ensure_future(feed_everything())
+            results = []
+            async for result in pipe.results():
+                results.append(result)
+                await asyncio.sleep(0.005)
+            await feeding
+            done.set()
+            await ticking
+            return results, ticks
+
+        results, ticks = asyncio.run(main())
+        self.assertEqual(results, [x + 1 for x in range(30)])
+        # The feeding and the reading took hundreds of milliseconds, during which the loop kept running
+        self.assertGreater(ticks, 20)
+
+    def test_stop_reading_early(self):
+        async def main():
+            pipe = AsyncPipeline(_Pipeline(), max_pending=2)
+            pipe.add_task(add_one, num=2)
+            pipe.start()
+            for i in range(100):
+                await pipe.feed(i)
+            await pipe.close_input()
+            async for result in pipe.results():
+                break
+            # The rest of the results are thrown away, and the pipeline still finishes
+            await asyncio.get_running_loop().run_in_executor(None, pipe._reader.join)
+            return pipe
+
+        pipe = asyncio.run(main())
+        self.assertTrue(all(not p.is_alive() for t in pipe._actual_tasks for p in t._processes))
+
+    def test_feeding_after_close(self):
+        async def main():
+            pipe = AsyncPipeline(_Pipeline())
+            pipe.add_task(add_one)
+            pipe.start()
+            await pipe.feed(1)
+            await pipe.join()
+            await pipe.feed(2)
+
+        self.assertRaises(SequenceError, asyncio.run, main())
+
+
+if __name__ == '__main__':
+    unittest.main()
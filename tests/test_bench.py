@@ -0,0 +1,38 @@
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+import json
+import os
+import tempfile
+import unittest
+from mpetl import bench
+
+
+class test_bench(unittest.TestCase):
+    def test_report(self):
+        handle, path = tempfile.mkstemp(suffix=".json")
+        os.close(handle)
+        try:
+            bench.main(["--items", "50", "--nums", "1,2", "--chunk-sizes", "10", "--payload-sizes", "8",
+                        "--repeat", "2", "--output", path])
+            with open(path) as f:
+                report = json.load(f)
+        finally:
+            os.unlink(path)
+
+        scenarios = [x["scenario"] for x in report["results"]]
+        self.assertEqual(scenarios, ["throughput"] * 2 + ["variants"] * 3 + ["messaging"] * 2 + ["latency"] * 2)
+        for result in report["results"]:
+            self.assertEqual(len(result["runs"]), 2)
+            self.assertGreater(result["seconds"], 0)
+            if result["scenario"] != "latency":
+                self.assertEqual(result["items"], 50)
+                self.assertGreater(result["items_per_second"], 0)
+        self.assertEqual(report["arguments"]["nums"], [1, 2])
+        self.assertIn("python", report["environment"])
+
+    def test_unknown_scenario(self):
+        self.assertRaises(SystemExit, bench.main, ["--scenarios", "throughput,juggling"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+import multiprocessing
+import os
+import tempfile
+import unittest
+from mpetl.cache import CacheSpec
+from mpetl.pipeline import _Pipeline
+
+num_calls = multiprocessing.Value('i', 0)
+
+
+def counted_fan_out(parameter, offset=0):
+    with num_calls.get_lock():
+        num_calls.value += 1
+    yield parameter + offset
+    yield -parameter
+
+
+def double(parameter):
+    return parameter * 2
+
+
+class test_cache(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        num_calls.value = 0
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.unlink(self.path + suffix)
+
+    def run_pipeline(self, items, **kwargs):
+        self.pipe = _Pipeline()
+        self.pipe.add_task(counted_fan_out, num=3, cache=CacheSpec(self.path), **kwargs)
+        self.pipe.add_task(double, num=2)
+        self.pipe.start()
+        for item in items:
+            self.pipe.feed(item)
+        return sorted(self.pipe.as_completed())
+
+    def test_rerun_skips_cached_items(self):
+        expected = sorted(y for x in range(20) for y in (x * 2, -x * 2))
+        self.assertEqual(self.run_pipeline(range(20)), expected)
+        self.assertEqual(num_calls.value, 20)
+        # Only the new items are computed the second time around
+        self.assertEqual(self.run_pipeline(range(25)), sorted(y for x in range(25) for y in (x * 2, -x * 2)))
+        self.assertEqual(num_calls.value, 25)
+
+    def test_keyword_arguments_are_part_of_the_key(self):
+        self.run_pipeline(range(10))
+        self.assertEqual(self.run_pipeline(range(10), offset=1), sorted(y for x in range(10)
+                                                                         for y in ((x + 1) * 2, -x * 2)))
+        self.assertEqual(num_calls.value, 20)
+
+    def test_ordered(self):
+        self.run_pipeline(range(10))
+        self.pipe = _Pipeline(ordered=True)
+        self.pipe.add_task(counted_fan_out, num=3, cache=CacheSpec(self.path))
+        self.pipe.start()
+        self.pipe.feed_chunk(list(range(15)))
+        self.assertEqual(list(self.pipe.as_completed()), [y for x in range(15) for y in (x, -x)])
+        self.assertEqual(num_calls.value, 15)
+
+    def test_eviction(self):
+        cache = CacheSpec(self.path, max_bytes=1000).open(("test",))
+        for i in range(100):
+            self.assertEqual(cache.call(lambda item, kwargs: ["x" * 50], i, {}), ["x" * 50])
+        total, = cache._db.execute("SELECT bytes FROM total").fetchone()
+        count, size = cache._db.execute("SELECT COUNT(*), SUM(size) FROM results").fetchone()
+        self.assertEqual(total, size)
+        self.assertLessEqual(total, 1000)
+        self.assertGreater(count, 5)
+        # The least recently used went first
+        self.assertEqual(cache._db.execute("SELECT COUNT(*) FROM results WHERE key = ?", (cache._key(0),)).fetchone(),
+                         (0,))
+        self.assertEqual(cache._db.execute("SELECT COUNT(*) FROM results WHERE key = ?", (cache._key(99),)).fetchone(),
+                         (1,))
+        cache.close()
+
+    def test_batch_tasks_cannot_cache(self):
+        self.pipe = _Pipeline()
+        self.assertRaises(ValueError, self.pipe.add_task, double, batch=True, cache=CacheSpec(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+import os
+import tempfile
+import threading
+import unittest
+from mpetl.checkpoint import Checkpoint
+from mpetl.pipeline import _Pipeline, _CompletionTracker
+
+
+def add_one(parameter):
+    return parameter + 1
+
+
+def ignore(parameter):
+    pass
+
+
+def fan_out_by_three(parameter):
+    for i in range(parameter % 3):
+        yield parameter * 10 + i
+
+
+class test_checkpoint(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        os.unlink(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def recorded(self):
+        with open(self.path) as f:
+            return sorted(int(x) for x in f)
+
+    def test_completion_tracker(self):
+        tracker = _CompletionTracker()
+        # Item 4 yields two results at the first stage; the second of them fans out into two more
+        self.assertIsNone(tracker.add((4, (1, True), (1, True))))
+        self.assertIsNone(tracker.add((4, (0, False), (0, True))))
+        self.assertEqual(tracker.add((7, (0, True), (0, True))), 7)
+        self.assertEqual(tracker.add((4, (1, True), (0, False))), 4)
+        self.assertEqual(tracker._open, {})
+
+    def test_records_chunks(self):
+        self.pipe = _Pipeline(checkpoint=self.path)
+        self.pipe.add_task(fan_out_by_three, num=2)
+        self.pipe.add_task(add_one, num=2)
+        self.pipe.start()
+        for i in range(10):
+            self.pipe.feed_chunk([i * 3 + x for x in range(3)])
+        self.pipe.feed_chunk([])
+        results = sorted(self.pipe.as_completed())
+        self.assertEqual(results, sorted(y * 10 + i + 1 for y in range(30) for i in range(y % 3)))
+        self.assertEqual(self.recorded(), list(range(11)))
+
+    def test_resume(self):
+        # A previous run got through chunks 0 and 2, and died halfway through writing the next line
+        with open(self.path, "w") as f:
+            f.write("0\n2\n1")
+        self.assertTrue(Checkpoint(self.path).done(2))
+        self.pipe = _Pipeline(resume_from=self.path)
+        self.pipe.add_task(add_one, num=2)
+        self.pipe.start()
+        for i in range(4):
+            self.pipe.feed_chunk([i * 10, i * 10 + 1])
+        self.assertEqual(sorted(self.pipe.as_completed()), [11, 12, 31, 32])
+        self.assertEqual(self.recorded(), [0, 1, 2, 3])
+
+    def test_ordered(self):
+        self.pipe = _Pipeline(ordered=True, checkpoint=self.path)
+        self.pipe.add_task(fan_out_by_three, num=3)
+        self.pipe.start()
+        for i in range(5):
+            self.pipe.feed_chunk([i * 2, i * 2 + 1])
+        self.assertEqual(list(self.pipe.as_completed()), [y * 10 + i for y in range(10) for i in range(y % 3)])
+        self.assertEqual(self.recorded(), list(range(5)))
+
+    def test_join_only(self):
+        self.pipe = _Pipeline(checkpoint=self.path)
+        self.pipe.add_task(add_one, num=2)
+        self.pipe.start()
+        for i in range(5):
+            self.pipe.feed_chunk([i * 2, i * 2 + 1])
+        self.pipe.join()
+        self.assertEqual(self.recorded(), list(range(5)))
+        # What join() read is still there for as_completed()
+        self.assertEqual(sorted(self.pipe.as_completed()), [x + 1 for x in range(10)])
+
+    def test_join_only_bounded(self):
+        # Items without results still put a placeholder each in the results queue, which only holds two chunks
+        self.pipe = _Pipeline(checkpoint=self.path, max_size=2)
+        self.pipe.add_task(ignore, num=1)
+        self.pipe.start()
+        for i in range(4):
+            self.pipe.feed(i)
+        joiner = threading.Thread(target=self.pipe.join, daemon=True)
+        joiner.start()
+        joiner.join(30)
+        self.assertFalse(joiner.is_alive())
+        self.assertEqual(self.recorded(), list(range(4)))
+        self.assertEqual(list(self.pipe.as_completed()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+import unittest
+from mpetl.chunking import AutoChunk
+from mpetl.pipeline import _Pipeline, _QTask
+
+
+def first_stage(parameter):
+    return parameter + 1
+
+
+def iterator_origin(up_to):
+    for i in range(up_to):
+        yield i
+
+    return
+
+
+class test_auto_chunk(unittest.TestCase):
+    def test_auto_string(self):
+        qtask = _QTask(first_stage, 1, "auto", None, None)
+        self.assertIsInstance(qtask._chunk_size, AutoChunk)
+
+    def test_unknown_string(self):
+        self.assertRaises(ValueError, _QTask, first_stage, 1, "adaptive", None, None)
+        self.assertRaises(ValueError, _QTask, first_stage, 1, "Auto", None, None)
+
+    def test_bad_bounds(self):
+        self.assertRaises(ValueError, AutoChunk, min_size=10, max_size=5)
+
+    def test_grows_towards_target(self):
+        # Items take 1ms to compute and puts take 1ms, so 10ms chunks should hold about 9 items.
+        sizer = AutoChunk(target=0.01, max_size=100).sizer()
+        for i in range(20):
+            size = sizer.observe(sizer.size * 0.001, sizer.size, 0.001)
+        self.assertEqual(size, 9)
+
+    def test_stays_within_bounds(self):
+        sizer = AutoChunk(target=1.0, min_size=2, max_size=50).sizer()
+        self.assertEqual(sizer.size, 2)
+        for i in range(20):
+            sizer.observe(0.0, sizer.size, 0.0)
+        self.assertEqual(sizer.size, 50)
+        # A put that costs more than the target can't push the size below the minimum
+        self.assertEqual(sizer.observe(10.0, 50, 5.0), 2)
+
+    def test_auto_pipeline(self):
+        self.pipe = _Pipeline()
+        self.pipe.add_origin(iterator_origin, num=1, chunk_size="auto")
+        self.pipe.add_task(first_stage, num=2, chunk_size=AutoChunk(target=0.001, max_size=64))
+        self.pipe.start()
+        self.pipe.feed(1000)
+        self.pipe.join()
+        self.assertEqual(sorted(self.pipe.as_completed()), [x + 1 for x in range(1000)])
+
+
+if __name__ == '__main__':
+    unittest.main()
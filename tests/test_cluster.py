@@ -0,0 +1,121 @@
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from mpetl import Coordinator
+from mpetl.bench import plain_task
+from mpetl.pipeline import _Pipeline
+from mpetl.worker import run_agent
+
+
+def add_one(parameter):
+    return parameter + 1
+
+
+def fan_out(parameter):
+    yield parameter
+    yield -parameter
+
+
+def drop_odd(parameter):
+    if parameter % 2 == 0:
+        return parameter
+
+
+def slow_add_one(parameter):
+    time.sleep(0.005)
+    return parameter + 1
+
+
+class test_cluster(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.coordinator = Coordinator()
+        cls.agents = [multiprocessing.Process(target=run_agent, args=(cls.coordinator.address,
+                                                                      cls.coordinator.authkey, 3))
+                      for x in range(2)]
+        [a.start() for a in cls.agents]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.coordinator.close()
+        [a.join() for a in cls.agents]
+
+    def test_stages_run_on_agents(self):
+        self.pipe = _Pipeline(coordinator=self.coordinator)
+        self.pipe.add_task(fan_out, num=2, chunk_size=10)
+        self.pipe.add_task(add_one, num=2, threads=2)
+        self.pipe.add_task(add_one, num=1, executor="thread")
+        self.pipe.start()
+        for i in range(20):
+            self.pipe.feed_chunk(list(range(i * 10, i * 10 + 10)))
+        results = sorted(self.pipe.as_completed())
+        self.assertEqual(results, sorted(y + 2 for x in range(200) for y in (x, -x)))
+        self.assertTrue(all(not p.is_alive() for t in self.pipe._actual_tasks for p in t._processes))
+
+    def test_ordered(self):
+        self.pipe = _Pipeline(coordinator=self.coordinator, ordered=True)
+        self.pipe.add_task(fan_out, num=3)
+        self.pipe.start()
+        for i in range(50):
+            self.pipe.feed(i)
+        self.assertEqual(list(self.pipe.as_completed()), [y for x in range(50) for y in (x, -x)])
+
+    def test_max_size(self):
+        self.pipe = _Pipeline(coordinator=self.coordinator, max_size=2)
+        self.pipe.add_task(slow_add_one, num=1)
+        self.pipe.start()
+        lengths = []
+
+        def feed_everything():
+            for i in range(50):
+                self.pipe.feed(i)
+                lengths.append(self.pipe.queue_lengths()[0])
+            self.pipe.join()
+
+        feeder = threading.Thread(target=feed_everything)
+        feeder.start()
+        self.assertEqual(sorted(self.pipe.as_completed(join=False)), [x + 1 for x in range(50)])
+        feeder.join()
+        self.assertLessEqual(max(lengths), 2)
+
+    def test_unsupported_options(self):
+        self.pipe = _Pipeline(coordinator=self.coordinator, stats=True)
+        self.pipe.add_task(add_one)
+        self.assertRaises(ValueError, self.pipe.start)
+        self.pipe = _Pipeline(coordinator=self.coordinator)
+        self.pipe.add_task(add_one, num=2, schedule="steal")
+        self.assertRaises(ValueError, self.pipe.start)
+
+
+class test_worker_command(unittest.TestCase):
+    def test_agent_from_the_command_line(self):
+        coordinator = Coordinator(authkey=b"not-a-secret")
+        host, port = coordinator.address
+        tests = os.path.dirname(os.path.abspath(__file__))
+        # Like an agent on another machine, this one doesn't share the coordinator's markers
+        env = {k: v for k, v in os.environ.items() if not k.startswith("MPETL_")}
+        env.update(MPETL_AUTHKEY="not-a-secret", PYTHONPATH=os.pathsep.join([os.path.dirname(tests), tests]))
+        agent = subprocess.Popen([sys.executable, "-m", "mpetl.worker", "%s:%d" % (host, port), "--slots", "2"],
+                                 env=env, cwd=os.path.dirname(tests))
+        try:
+            pipe = _Pipeline(coordinator=coordinator, ordered=True)
+            pipe.add_task(plain_task, num=2, chunk_size=5)
+            pipe.add_task(drop_odd, num=2)
+            pipe.start()
+            for i in range(20):
+                pipe.feed(i)
+            self.assertEqual(list(pipe.as_completed()), list(range(0, 20, 2)))
+        finally:
+            coordinator.close()
+            # The agent finishes once its coordinator does
+            self.assertEqual(agent.wait(30), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
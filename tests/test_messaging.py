@@ -3,6 +3,9 @@
 __author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
 
 import unittest
+import multiprocessing
+import queue
+import time
 from mpetl.pipeline import _Pipeline
 from mpetl.messaging import *
 
@@ -26,6 +29,10 @@ def gathering_function(number):
     return number
 
 
+def payload_size(payload):
+    return type(payload).__name__, len(payload), bytes(payload[:3])
+
+
 class test_messaging(unittest.TestCase):
     def setUp(self):
         self.messaging = MessagingCenter()
@@ -61,5 +68,46 @@ class test_messaging(unittest.TestCase):
         self.messaging.forget_pipeline("odd")
         self.messaging.forget_pipeline("even")
 
+    def test_large_payloads(self):
+        self.messaging._oob_threshold = 1024
+        self.sizes = _Pipeline()
+        self.sizes.add_destination(payload_size)
+        self.sizes.start()
+        self.messaging.register_pipeline("sizes", self.sizes)
+
+        self.messaging.send_message("sizes", [b"x" * 50000, bytearray(b"y" * 50000), b"small"])
+        self.messaging.flush()
+        self.sizes.join()
+        self.assertEqual(sorted(self.sizes.as_completed()),
+                         [("bytearray", 50000, b"yyy"), ("bytes", 5, b"sma"), ("bytes", 50000, b"xxx")])
+        self.messaging.forget_pipeline("sizes")
+
+
+class test_send_buffers(unittest.TestCase):
+    def test_batches(self):
+        messaging = MessagingCenter(batch_size=10, linger=60)
+        messaging.start()
+        received = multiprocessing.Queue()
+        messaging.register_pipeline_queue("batches", received)
+        for i in range(25):
+            messaging.send_message("batches", [i])
+        messaging.flush()
+        chunks = [received.get(timeout=5) for x in range(3)]
+        self.assertEqual([len(x) for x in chunks], [10, 10, 5])
+        self.assertEqual(sum(chunks, []), list(range(25)))
+        messaging.forget_pipeline("batches")
+
+    def test_linger(self):
+        messaging = MessagingCenter(batch_size=1000, linger=0.05)
+        messaging.start()
+        received = multiprocessing.Queue()
+        messaging.register_pipeline_queue("linger", received)
+        messaging.send_message("linger", [1])
+        messaging.send_message("linger", [2])
+        # Never flushed; the buffer goes out on its own
+        self.assertEqual(received.get(timeout=5), [1, 2])
+        messaging.forget_pipeline("linger")
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -58,6 +58,28 @@ def final_pipeline_reduce(number, accumulator=[0], counter=[0]):
 
     return
 
+def received_items(q, count):
+    """Reads count items from a queue registered with the messaging center, which may batch several in one chunk."""
+    items = []
+    while len(items) < count:
+        items.extend(q.get())
+    return items
+
+def send_to_shm_pipeline(number):
+    Pipeline.send("shm destination", number)
+
+def send_to_direct_pipeline(number):
+    Pipeline.send("direct destination", number)
+
+def send_to_both_spawn_pipelines(number):
+    Pipeline.send("spawn destination", number)
+    Pipeline.send("direct spawn destination", -number)
+
+
+def identity(number):
+    return number
+
+
 class TestPipeline(unittest.TestCase):
     def build_first_pipeline(self):
         self.first = Pipeline("first one")
@@ -75,7 +97,7 @@ class TestPipeline(unittest.TestCase):
         self.first.feed(6)
         # We should get back the set (0, 1, 2, 3, 4, 5)
         self.first.join()
-        self.assertEqual(set(q.get()[0] for x in range(6)), set(x for x in range(6)))
+        self.assertEqual(set(received_items(q, 6)), set(x for x in range(6)))
         q.close()
 
     def build_divisible_pipeline(self):
@@ -91,7 +113,7 @@ class TestPipeline(unittest.TestCase):
         self.divisible.feed(6)
         self.divisible.join()
         # We should get two numbers, 0 * 7 and 1 * 7
-        self.assertEqual(set(q.get()[0] for x in range(2)), set([0, 7]))
+        self.assertEqual(set(received_items(q, 2)), set([0, 7]))
         q.close()
 
     def build_nondivisible_pipeline(self):
@@ -108,7 +130,7 @@ class TestPipeline(unittest.TestCase):
         self.nondivisible.feed(6)
         self.nondivisible.join()
         # We should get six numbers, 0, 1, 2, 3, 4, 5, each / 2 and * 3
-        self.assertEqual(set(q.get()[0] for x in range(6)), set(x / 2 * 3 for x in range(6)))
+        self.assertEqual(set(received_items(q, 6)), set(x / 2 * 3 for x in range(6)))
         q.close()
 
     def build_final_pipeline(self):
@@ -168,6 +190,58 @@ class TestPipeline(unittest.TestCase):
         result = [x for x in self.final.as_completed()]
         self.assertGreater(len(result), 0)
 
+    def test_named_shm_pipeline(self):
+        source = Pipeline()
+        source.add_origin(first_pipeline_origin)
+        source.add_destination(send_to_shm_pipeline, num=2)
+        destination = Pipeline(name="shm destination", transport="shm")
+        destination.add_task(identity)
+        source.start()
+        destination.start()
+        source.feed(50)
+        source.join()
+        destination.join()
+        self.assertEqual(sorted(destination.as_completed()), list(range(50)))
+
+    def test_direct_routing(self):
+        destination = Pipeline(name="direct destination", direct_routing=True)
+        destination.add_task(identity)
+        destination.start()
+        # The destination started first, so the source's workers know its input queue and put into it themselves
+        self.assertIs(Pipeline._messaging._routes["direct destination"], destination.input_queue)
+        source = Pipeline()
+        source.add_origin(first_pipeline_origin)
+        source.add_destination(send_to_direct_pipeline, num=2)
+        source.start()
+        source.feed(50)
+        source.join()
+        destination.join()
+        self.assertEqual(sorted(destination.as_completed()), list(range(50)))
+        Pipeline._messaging.forget_pipeline("direct destination")
+
+    def test_spawned_workers_send(self):
+        relayed = Pipeline(name="spawn destination")
+        relayed.add_task(identity)
+        relayed.start()
+        direct = Pipeline(name="direct spawn destination", direct_routing=True)
+        direct.add_task(identity)
+        direct.start()
+        # Spawned workers don't inherit the MessagingCenter, and are given what they need to send through it
+        source = Pipeline(start_method="spawn")
+        source.add_destination(send_to_both_spawn_pipelines, num=2)
+        source.start()
+        for i in range(20):
+            source.feed(i)
+        source.join()
+        relayed.join()
+        direct.join()
+        self.assertEqual(sorted(relayed.as_completed()), list(range(20)))
+        self.assertEqual(sorted(direct.as_completed()), list(range(-19, 1)))
+        Pipeline._messaging.forget_pipeline("direct spawn destination")
+
+    def test_named_pipelines_are_unordered(self):
+        self.assertRaises(ValueError, Pipeline, name="ordered destination", ordered=True)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,120 @@
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+import multiprocessing
+import os
+import unittest
+from mpetl import Pipeline
+from mpetl.pipeline import _Pipeline
+from mpetl.pool import WorkerPool
+
+num_setups = multiprocessing.Value('i', 0)
+num_teardowns = multiprocessing.Value('i', 0)
+
+
+def setup_connection():
+    with num_setups.get_lock():
+        num_setups.value += 1
+    return os.getpid()
+
+
+def teardown_connection(persistent):
+    with num_teardowns.get_lock():
+        num_teardowns.value += 1
+
+
+def tag_with_connection(parameter, process_persistent):
+    return parameter, process_persistent
+
+
+def add_one(parameter):
+    return parameter + 1
+
+
+def ignore(parameter):
+    pass
+
+
+def send_to_pool_destination(parameter):
+    Pipeline.send("pool destination", parameter)
+
+
+class test_worker_pool(unittest.TestCase):
+    def setUp(self):
+        num_setups.value = num_teardowns.value = 0
+        self.pool = WorkerPool(3, channels=6)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def run_pipeline(self, items):
+        pipe = _Pipeline(pool=self.pool)
+        pipe.add_task(add_one, num=1)
+        pipe.add_task(tag_with_connection, num=2, setup=setup_connection, teardown=teardown_connection)
+        pipe.start()
+        for i in range(items):
+            pipe.feed(i)
+        pipe.join()
+        return sorted(pipe.as_completed())
+
+    def test_reuses_workers(self):
+        first = self.run_pipeline(20)
+        second = self.run_pipeline(20)
+        self.assertEqual([x for x, pid in first], list(range(1, 21)))
+        self.assertEqual([x for x, pid in second], list(range(1, 21)))
+        pids = set(p.pid for p in self.pool._processes)
+        self.assertTrue(set(pid for x, pid in first + second) <= pids)
+        # Each of the two workers that ran tag_with_connection set up once, for both pipelines, and hasn't torn down
+        self.assertLessEqual(num_setups.value, 2)
+        self.assertEqual(num_teardowns.value, 0)
+        self.pool.close()
+        self.assertEqual(num_teardowns.value, num_setups.value)
+
+    def test_join_only_pipelines(self):
+        # Each of these borrows three of the pool's six channels, and gives them back when it's joined
+        for x in range(5):
+            pipe = _Pipeline(pool=self.pool)
+            pipe.add_task(add_one, num=1)
+            pipe.add_task(ignore, num=2)
+            pipe.start()
+            for i in range(10):
+                pipe.feed(i)
+            pipe.join()
+        self.assertEqual(len(self.pool._free_channels), 6)
+        self.assertEqual(list(pipe.as_completed()), [])
+        # Results that haven't been read keep their channel until they are
+        pipe = _Pipeline(pool=self.pool)
+        pipe.add_task(add_one, num=2)
+        pipe.start()
+        pipe.feed(1)
+        pipe.join()
+        self.assertEqual(len(self.pool._free_channels), 5)
+        self.assertEqual(list(pipe.as_completed()), [2])
+        self.assertEqual(len(self.pool._free_channels), 6)
+
+    def test_not_enough_workers(self):
+        pipe = _Pipeline(pool=self.pool)
+        pipe.add_task(add_one, num=4)
+        self.assertRaises(ValueError, pipe.start)
+
+    def test_no_stats(self):
+        pipe = _Pipeline(pool=self.pool, stats=True)
+        pipe.add_task(add_one)
+        self.assertRaises(ValueError, pipe.start)
+
+
+class test_pool_messaging(unittest.TestCase):
+    def test_sends_arrive_before_join(self):
+        destination = Pipeline(name="pool destination")
+        destination.add_task(add_one)
+        destination.start()
+        # Started after the MessagingCenter, so that its workers can send
+        with WorkerPool(2) as pool:
+            source = Pipeline(pool=pool)
+            source.add_destination(send_to_pool_destination, num=2)
+            source.start()
+            for i in range(7):
+                source.feed(i)
+            source.join()
+            # The pool's workers are still alive, and haven't sent anything on their way out
+            destination.join()
+        self.assertEqual(sorted(destination.as_completed()), [x + 1 for x in range(7)])
@@ -0,0 +1,101 @@
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+import os
+import signal
+import unittest
+from mpetl import WorkerPool
+from mpetl.pipeline import _Pipeline, SequenceError
+from mpetl.profiling import enable_profiling_trap
+
+
+def profiled_stage(parameter):
+    return sum(range(parameter))
+
+
+def other_stage(parameter):
+    return parameter + 1
+
+
+def functions_in(stats):
+    return set(name for filename, line, name in stats.stats)
+
+
+class test_profiling(unittest.TestCase):
+    def test_profile_from_the_start(self):
+        self.pipe = _Pipeline(profile=True)
+        self.pipe.add_task(profiled_stage, num=2)
+        self.pipe.add_task(other_stage, num=2)
+        self.pipe.start()
+        self.assertRaises(SequenceError, self.pipe.profiles)
+        for i in range(50):
+            self.pipe.feed(i)
+        self.assertEqual(sorted(self.pipe.as_completed()), sorted(sum(range(x)) + 1 for x in range(50)))
+        profiles = self.pipe.profiles()
+        self.assertEqual(sorted(profiles), ["other_stage", "profiled_stage"])
+        self.assertIn("profiled_stage", functions_in(profiles["profiled_stage"]))
+        self.assertNotIn("profiled_stage", functions_in(profiles["other_stage"]))
+        self.assertFalse(os.path.exists(self.pipe._profile_dir))
+
+    def test_profile_on_demand(self):
+        self.pipe = _Pipeline()
+        self.pipe.add_task(profiled_stage, num=2)
+        self.pipe.add_task(other_stage, num=1)
+        self.pipe.start()
+        for i in range(20):
+            self.pipe.feed(i)
+        self.pipe.start_profiling()
+        for i in range(20):
+            self.pipe.feed(i)
+        self.pipe.join()
+        list(self.pipe.as_completed())
+        self.assertIn("profiled_stage", functions_in(self.pipe.profiles()["profiled_stage"]))
+
+    def test_off_by_default(self):
+        self.pipe = _Pipeline()
+        self.pipe.add_task(profiled_stage, num=2)
+        self.pipe.start()
+        self.pipe.feed(10)
+        self.pipe.join()
+        self.assertEqual(list(self.pipe.as_completed()), [45])
+        self.assertEqual(self.pipe.profiles(), {})
+        # The directory for the profiles is only created when profiling is switched on
+        self.assertFalse(os.path.exists(self.pipe._profile_dir))
+
+    def test_pool(self):
+        with WorkerPool(size=1) as pool:
+            self.pipe = _Pipeline(profile=True, pool=pool)
+            self.pipe.add_task(profiled_stage)
+            self.assertRaises(ValueError, self.pipe.start)
+            self.pipe = _Pipeline(pool=pool)
+            self.pipe.add_task(profiled_stage)
+            self.pipe.start()
+            self.assertRaises(ValueError, self.pipe.start_profiling)
+            self.pipe.join()
+
+    def test_spawn(self):
+        self.pipe = _Pipeline(profile=True, start_method="spawn")
+        self.pipe.add_task(profiled_stage, num=2)
+        self.pipe.start()
+        self.pipe.feed(10)
+        self.pipe.join()
+        self.assertEqual(list(self.pipe.as_completed()), [45])
+        self.assertIn("profiled_stage", functions_in(self.pipe.profiles()["profiled_stage"]))
+
+    def test_signal(self):
+        previous = signal.getsignal(signal.SIGUSR2)
+        try:
+            self.pipe = _Pipeline()
+            self.pipe.add_task(profiled_stage)
+            self.pipe.start()
+            enable_profiling_trap()
+            os.kill(os.getpid(), signal.SIGUSR2)
+            self.assertEqual(self.pipe._profiling.value, 1)
+            os.kill(os.getpid(), signal.SIGUSR2)
+            self.assertEqual(self.pipe._profiling.value, 0)
+            self.pipe.join()
+        finally:
+            signal.signal(signal.SIGUSR2, previous)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
 __author__ = 'jrherskovic'
 
+import asyncio
+import importlib.util
 import unittest
 import multiprocessing
 from mpetl.pipeline import _QTask
@@ -36,6 +38,46 @@ def do_something_external(parameter, process_persistent):
     return parameter
 
 
+num_setups = multiprocessing.Value('i', 0)
+
+def counting_setup():
+    with num_setups.get_lock():
+        num_setups.value += 1
+    return num_setups.value
+
+
+def return_persistent(parameter, process_persistent):
+    return process_persistent
+
+
+IN_FLIGHT = [0]
+
+async def async_task(parameter):
+    IN_FLIGHT[0] += 1
+    seen = IN_FLIGHT[0]
+    await asyncio.sleep(0.05)
+    IN_FLIGHT[0] -= 1
+    return (parameter, seen)
+
+
+async def async_generator_task(parameter):
+    for i in range(parameter):
+        await asyncio.sleep(0)
+        yield i
+
+
+def batch_task(chunk):
+    return [(len(chunk), x * 2) for x in chunk]
+
+
+def columnar_batch_task(left, right):
+    return (left * right).tolist()
+
+
+def task_with_batch_parameter(parameter, batch):
+    return (parameter, batch)
+
+
 class test_qtask(unittest.TestCase):
     def test_creation(self):
         null_qtask = _QTask(None, None, None, None, None)
@@ -148,5 +190,95 @@ class test_qtask(unittest.TestCase):
         # The teardown should have executed and we should have seen a total of one hello
         self.assertEqual(num_hellos.value, 1)
 
+    def gather(self, num_items):
+        result = []
+        while len(result) < num_items:
+            result += self.output_q.get()
+        return result
+
+    def test_thread_executor(self):
+        self.qtask = _QTask(null_task, 4, 3, None, None, executor="thread")
+        self.input_q = multiprocessing.Queue()
+        self.output_q = multiprocessing.Queue()
+        self.qtask.instantiate(self.input_q, self.output_q)
+        [self.input_q.put([x]) for x in range(100)]
+        self.qtask.join()
+        self.assertEqual(sorted(self.gather(100)), list(range(100)))
+
+    def test_threads_per_process_setup(self, setup_scope="process", expected_setups=2):
+        num_setups.value = 0
+        self.qtask = _QTask(return_persistent, 2, 1, counting_setup, None, threads=3, setup_scope=setup_scope)
+        self.input_q = multiprocessing.Queue()
+        self.output_q = multiprocessing.Queue()
+        self.qtask.instantiate(self.input_q, self.output_q)
+        [self.input_q.put([x]) for x in range(30)]
+        self.qtask.join()
+        self.gather(30)
+        self.assertEqual(num_setups.value, expected_setups)
+
+    def test_threads_per_thread_setup(self):
+        self.test_threads_per_process_setup("thread", 6)
+
+    def test_coroutine_concurrency(self):
+        self.qtask = _QTask(async_task, 1, 1, None, None, concurrency=4)
+        self.input_q = multiprocessing.Queue()
+        self.output_q = multiprocessing.Queue()
+        self.qtask.instantiate(self.input_q, self.output_q)
+        self.input_q.put(list(range(10)))
+        self.qtask.join()
+        result = self.gather(10)
+        self.assertEqual(sorted(x[0] for x in result), list(range(10)))
+        # Never more than four coroutines at the same time, but more than one
+        self.assertEqual(max(x[1] for x in result), 4)
+
+    def test_async_generator(self):
+        self.qtask = _QTask(async_generator_task, 2, 5, None, None, concurrency=3)
+        self.input_q = multiprocessing.Queue()
+        self.output_q = multiprocessing.Queue()
+        self.qtask.instantiate(self.input_q, self.output_q)
+        self.input_q.put([3, 4])
+        self.input_q.put([5])
+        self.qtask.join()
+        self.assertEqual(sorted(self.gather(12)), sorted([0, 1, 2, 0, 1, 2, 3, 0, 1, 2, 3, 4]))
+
+    def test_batch(self):
+        self.qtask = _QTask(batch_task, 1, 100, None, None, batch=True)
+        self.input_q = multiprocessing.Queue()
+        self.output_q = multiprocessing.Queue()
+        self.qtask.instantiate(self.input_q, self.output_q)
+        self.input_q.put([1, 2, 3])
+        self.input_q.put([4])
+        self.qtask.join()
+        # The callable saw each chunk whole
+        self.assertEqual(sorted(self.gather(4)), [(1, 8), (3, 2), (3, 4), (3, 6)])
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "NumPy is not installed")
+    def test_numpy_batch(self):
+        self.qtask = _QTask(columnar_batch_task, 1, 100, None, None, batch="numpy")
+        self.input_q = multiprocessing.Queue()
+        self.output_q = multiprocessing.Queue()
+        self.qtask.instantiate(self.input_q, self.output_q)
+        self.input_q.put([(1, 2), (3, 4), (5, 6)])
+        self.qtask.join()
+        self.assertEqual(sorted(self.gather(3)), [2, 12, 30])
+
+    def test_bad_batch(self):
+        self.assertRaises(ValueError, _QTask, null_task, 1, 1, None, None, batch="pandas")
+        self.assertRaises(ValueError, _QTask, async_task, 1, 1, None, None, batch=True)
+
+    def test_option_declared_by_callable(self):
+        # The callable has a parameter called batch, so batch=500 is for it and not a task option.
+        self.qtask = _QTask(task_with_batch_parameter, 1, 1, None, None, batch=500)
+        self.assertFalse(self.qtask._batch)
+        self.input_q = multiprocessing.Queue()
+        self.output_q = multiprocessing.Queue()
+        self.qtask.instantiate(self.input_q, self.output_q)
+        self.input_q.put([1])
+        self.qtask.join()
+        self.assertEqual(self.output_q.get(), [(1, 500)])
+
+    def test_bad_executor(self):
+        self.assertRaises(ValueError, _QTask, null_task, 1, 1, None, None, executor="fiber")
+
 if __name__ == '__main__':
     unittest.main()
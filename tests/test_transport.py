@@ -0,0 +1,264 @@
+__author__ = 'Jorge R. Herskovic <jherskovic@gmail.com>'
+
+import functools
+import multiprocessing
+import os
+import queue
+import unittest
+from mpetl.pipeline import _Pipeline
+from mpetl.transport import SharedMemoryQueue, SpillingQueue, make_queue, dumps, loads, discard, _StealingQueue
+from mpetl.util import SENTINEL
+
+
+def payload_size(payload):
+    return (type(payload).__name__, len(payload), bytes(payload[:3]))
+
+
+def first_stage(parameter):
+    return parameter + 1
+
+
+def iterator_origin(up_to):
+    for i in range(up_to):
+        yield i
+
+    return
+
+
+class test_shared_memory_queue(unittest.TestCase):
+    def setUp(self):
+        self.q = SharedMemoryQueue(capacity=256)
+
+    def tearDown(self):
+        self.q.close()
+
+    def test_fifo(self):
+        [self.q.put([x]) for x in range(5)]
+        self.assertEqual(self.q.qsize(), 5)
+        self.assertEqual([self.q.get() for x in range(5)], [[x] for x in range(5)])
+        self.assertTrue(self.q.empty())
+
+    def test_wraparound(self):
+        # Each item takes up a sizable fraction of the buffer, so the writes wrap around many times.
+        for i in range(100):
+            self.q.put("x" * 50 + str(i))
+            self.assertEqual(self.q.get(), "x" * 50 + str(i))
+
+    def test_blocking_semantics(self):
+        bounded = SharedMemoryQueue(maxsize=2, capacity=256)
+        bounded.put(1)
+        bounded.put(2)
+        self.assertRaises(queue.Full, bounded.put, 3, True, 0.01)
+        self.assertEqual(bounded.get(), 1)
+        bounded.put(3)
+        self.assertRaises(queue.Full, bounded.put_nowait, 4)
+        bounded.close()
+        self.assertRaises(queue.Empty, self.q.get, True, 0.01)
+
+    def test_too_large(self):
+        self.assertRaises(ValueError, self.q.put, "x" * 1000)
+
+    def test_unknown_transport(self):
+        self.assertRaises(ValueError, make_queue, "carrier pigeon")
+
+
+def produce_into(q, num_items):
+    for i in range(num_items):
+        q.put(str(i) * (i % 50))
+
+
+class test_spilling_queue(unittest.TestCase):
+    def setUp(self):
+        self.q = SpillingQueue(capacity=512, segment_size=2048)
+
+    def tearDown(self):
+        self.q.close()
+
+    def segment_files(self):
+        return os.listdir(self.q._spill_dir)
+
+    def test_fifo_through_disk(self):
+        items = [str(i) * (i % 50) for i in range(500)]
+        [self.q.put(x) for x in items]
+        self.assertEqual(self.q.qsize(), 500)
+        self.assertGreater(len(self.segment_files()), 1)
+        # Once the ring has room again new items still wait behind the spilled ones
+        self.assertEqual([self.q.get() for x in range(250)], items[:250])
+        self.q.put("late")
+        self.assertEqual([self.q.get() for x in range(250)], items[250:])
+        self.assertEqual(self.q.get(), "late")
+        self.assertLessEqual(len(self.segment_files()), 1)
+        self.assertRaises(queue.Empty, self.q.get, True, 0.01)
+
+    def test_larger_than_segment(self):
+        self.q.put("x" * 10000)
+        self.q.put("y")
+        self.assertEqual(self.q.get(), "x" * 10000)
+        self.assertEqual(self.q.get(), "y")
+
+    def test_maxsize(self):
+        bounded = SpillingQueue(maxsize=2, capacity=512)
+        bounded.put(1)
+        bounded.put("x" * 1000)
+        self.assertRaises(queue.Full, bounded.put, 3, True, 0.01)
+        self.assertEqual(bounded.get(), 1)
+        bounded.close()
+
+    def test_other_process(self):
+        producer = multiprocessing.Process(target=produce_into, args=(self.q, 300))
+        producer.start()
+        producer.join()
+        self.assertEqual([self.q.get() for x in range(300)], [str(i) * (i % 50) for i in range(300)])
+
+    def test_pipeline_transport(self):
+        spilling = make_queue("spill")
+        self.assertIsInstance(spilling, SpillingQueue)
+        spilling.close()
+        self.pipe = _Pipeline(transport=functools.partial(SpillingQueue, capacity=1024, segment_size=4096))
+        self.pipe.add_origin(iterator_origin, num=1, chunk_size=7)
+        self.pipe.add_task(first_stage, num=3)
+        self.pipe.start()
+        self.pipe.feed(1000)
+        self.pipe.join()
+        self.assertEqual(sorted(self.pipe.as_completed()), [x + 1 for x in range(1000)])
+
+
+class test_out_of_band(unittest.TestCase):
+    def test_round_trip(self):
+        big = b"a" * 1000
+        obj = {"bytes": big, "bytearray": bytearray(big), "view": memoryview(bytearray(big)).cast('I'), "small": b"s"}
+        data, blocks = dumps(obj, threshold=100)
+        # The three large buffers went out-of-band; the pickle itself is small.
+        self.assertEqual(len(blocks), 3)
+        self.assertLess(len(data), 500)
+        result = loads(data)
+        self.assertEqual(result["bytes"], big)
+        self.assertEqual(result["bytearray"], bytearray(big))
+        self.assertEqual(result["view"].format, 'I')
+        self.assertEqual(result["view"].tobytes(), big)
+        self.assertEqual(result["small"], b"s")
+        # Loading removed the blocks' names
+        if os.path.isdir("/dev/shm"):
+            self.assertFalse(any(os.path.exists("/dev/shm/" + name) for name in blocks))
+
+    def test_discard(self):
+        data, blocks = dumps([b"a" * 1000], threshold=100)
+        self.assertEqual(len(blocks), 1)
+        discard(data)
+        if os.path.isdir("/dev/shm"):
+            self.assertFalse(os.path.exists("/dev/shm/" + blocks[0]))
+
+    def test_larger_than_ring(self):
+        # Out-of-band buffers don't count against the ring's capacity.
+        q = SharedMemoryQueue(capacity=1024, oob_threshold=512)
+        q.put([bytearray(b"b" * 100000)])
+        self.assertEqual(q.get(), [bytearray(b"b" * 100000)])
+        q.close()
+
+    def test_pipeline(self):
+        self.pipe = _Pipeline(transport=lambda max_size: SharedMemoryQueue(max_size, 4096, oob_threshold=1024))
+        self.pipe.add_task(payload_size, num=2)
+        self.pipe.start()
+        self.pipe.feed_chunk([b"x" * 50000, bytearray(b"y" * 50000), memoryview(b"z" * 50000)])
+        self.pipe.join()
+        self.assertEqual(sorted(self.pipe.as_completed()),
+                         [("bytearray", 50000, b"yyy"), ("bytes", 50000, b"xxx"), ("memoryview", 50000, b"zzz")])
+
+
+class test_shm_pipeline(unittest.TestCase):
+    def test_pipeline_transport(self):
+        self.pipe = _Pipeline(transport="shm")
+        self.pipe.add_origin(iterator_origin, num=1, chunk_size=7)
+        self.pipe.add_task(first_stage, num=3)
+        self.pipe.start()
+        self.pipe.feed(100)
+        self.pipe.join()
+        self.assertEqual(set(self.pipe.as_completed()), set(x + 1 for x in range(100)))
+
+    def test_per_stage_transport(self):
+        self.pipe = _Pipeline(max_size=5)
+        self.pipe.add_origin(iterator_origin, num=1)
+        self.pipe.add_task(first_stage, num=2, transport="shm")
+        self.pipe.start()
+        self.assertIsInstance(self.pipe._queues[1], SharedMemoryQueue)
+        self.pipe.feed(20)
+        self.assertEqual(sorted(self.pipe.as_completed()), [x + 1 for x in range(20)])
+
+
+class test_byte_bounds(unittest.TestCase):
+    def test_blocks_on_bytes(self):
+        for transport in ("queue", "shm"):
+            bounded = make_queue(transport, max_bytes=1000)
+            bounded.put("x" * 400)
+            bounded.put("y" * 400)
+            self.assertRaises(queue.Full, bounded.put, "z" * 400, True, 0.01)
+            # Small chunks still fit
+            bounded.put("small")
+            self.assertEqual(bounded.get(), "x" * 400)
+            bounded.put("z" * 400)
+            self.assertEqual([bounded.get() for x in range(3)], ["y" * 400, "small", "z" * 400])
+            self.assertEqual(bounded.bytes_in_flight, 0)
+            bounded.close()
+
+    def test_oversized_chunk(self):
+        bounded = make_queue(max_bytes=100)
+        bounded.put("x" * 1000)
+        self.assertRaises(queue.Full, bounded.put_nowait, "y")
+        self.assertEqual(bounded.get(), "x" * 1000)
+        bounded.put_nowait("y")
+        self.assertEqual(bounded.get(), "y")
+
+    def test_pipeline(self):
+        self.pipe = _Pipeline(max_bytes=200)
+        self.pipe.add_origin(iterator_origin, num=1, chunk_size=10)
+        self.pipe.add_task(first_stage, num=2, max_bytes=10000)
+        self.pipe.start()
+        self.assertEqual([x._max_bytes for x in self.pipe._queues], [200, 10000, 200])
+        self.pipe.feed(500)
+        self.assertEqual(sorted(self.pipe.as_completed()), [x + 1 for x in range(500)])
+
+
+class test_work_stealing(unittest.TestCase):
+    def test_steals_chunks_but_not_markers(self):
+        stealing = _StealingQueue([queue.Queue(), queue.Queue()])
+        for chunk in ([1], [2], [3], [4]):
+            stealing.put(chunk)
+        worker = stealing.for_worker(0)
+        # Its own two chunks first, then the other worker's
+        self.assertEqual([worker.get() for x in range(4)], [[1], [3], [2], [4]])
+
+        stealing.put(SENTINEL)
+        stealing.put(SENTINEL)
+        self.assertEqual(worker.get(), SENTINEL)
+        # The other worker's SENTINEL goes back where it was
+        self.assertRaises(queue.Empty, worker.get, timeout=0.05)
+        self.assertEqual(stealing.for_worker(1).get(timeout=0.05), SENTINEL)
+        self.assertEqual(stealing.qsize(), 0)
+
+    def test_keeps_stealing_past_markers(self):
+        stealing = _StealingQueue([queue.Queue(), queue.Queue()])
+        # The first of two upstream workers finished; the other one is still filling the queues
+        stealing.put(SENTINEL)
+        stealing.put(SENTINEL)
+        stealing.for_worker(0).get()
+        stealing.queues[1].put([5])
+        self.assertEqual(stealing.for_worker(0).get(timeout=0.05), [5])
+        self.assertEqual(stealing.queues[1].get(False), SENTINEL)
+
+    def test_pipeline(self):
+        self.pipe = _Pipeline()
+        self.pipe.add_origin(iterator_origin, num=1, chunk_size=3)
+        self.pipe.add_task(first_stage, num=4, schedule="steal")
+        self.pipe.start()
+        self.pipe.feed(200)
+        self.pipe.join()
+        self.assertEqual(sorted(self.pipe.as_completed()), [x + 1 for x in range(200)])
+
+    def test_bad_schedule(self):
+        self.pipe = _Pipeline()
+        self.assertRaises(ValueError, self.pipe.add_task, first_stage, schedule="random")
+        self.assertRaises(ValueError, self.pipe.add_task, first_stage, min_num=1, max_num=3, schedule="steal")
+
+
+if __name__ == '__main__':
+    unittest.main()